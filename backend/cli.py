@@ -0,0 +1,40 @@
+import argparse
+
+from process import SAMPLES, build_sample_index, invalidate_nmf_go_cache
+
+
+def build_index(args):
+    sample_ids = args.samples or list(SAMPLES)
+    for sample_id in sample_ids:
+        try:
+            build_sample_index(sample_id, force=args.force)
+        except Exception as e:
+            print(f"Failed to build index for {sample_id}: {str(e)}")
+
+
+def clear_nmf_cache(args):
+    if not args.samples:
+        print(f"Removed {invalidate_nmf_go_cache()} stored NMF / GO results")
+    for sample_id in args.samples:
+        print(f"Removed {invalidate_nmf_go_cache(sample_id)} stored NMF / GO results of {sample_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BioVisLLM backend maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build-index", help="Precompute the sidecar metadata index of each sample")
+    build.add_argument("samples", nargs="*", help="Sample IDs to index (default: every entry in SAMPLES)")
+    build.add_argument("--force", action="store_true", help="Rebuild even if the index is up to date")
+    build.set_defaults(func=build_index)
+
+    clear = subparsers.add_parser("clear-nmf-cache", help="Delete stored NMF / GO results")
+    clear.add_argument("samples", nargs="*", help="Sample IDs whose results to delete (default: all)")
+    clear.set_defaults(func=clear_nmf_cache)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+import atexit
+import json
+import os
+import pickle
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+
+# analyses that can run as jobs: kind -> function name in process.py
+JOB_KINDS = {
+    "NMF_GO": "get_NMF_GO_data",
+    "cell_cell_interaction": "get_cell_cell_interaction_data",
+    "deaplog": "get_deaplog_results",
+}
+
+# number of jobs running at once, and finished jobs kept for polling
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "2"))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "100"))
+
+ACTIVE_STATES = ("queued", "running")
+
+
+# write a small JSON record atomically
+def _write_json(path, record):
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f)
+    os.replace(path + ".tmp", path)
+
+
+# run the analysis named in a job file and write its outcome next to it
+# (<job file>.out), in a worker process; the analysis' progress reports are
+# written to <job file>.progress as they come
+def _run_job(job_path):
+    with open(job_path, "rb") as f:
+        function_name, params = pickle.load(f)
+    import process
+
+    process.set_progress_reporter(lambda progress: _write_json(job_path + ".progress", progress))
+    try:
+        outcome = ("done", getattr(process, function_name)(**params), None)
+    except Exception as e:
+        traceback.print_exc()
+        outcome = ("failed", None, str(e))
+    finally:
+        process.set_progress_reporter(None)
+
+    with open(job_path + ".out.tmp", "wb") as f:
+        pickle.dump(outcome, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(job_path + ".out.tmp", job_path + ".out")
+
+
+# entry point of a worker process (python jobs.py): run the job files whose
+# paths arrive on stdin, one per line, until stdin closes. Workers live across
+# jobs, so process.py's caches (loaded samples, indexes, gene sets) stay warm
+def _worker():
+    # being stopped unwinds the running job, so anything it started in a
+    # session of its own (Spacia) is stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            return
+        _run_job(line.strip())
+
+
+class JobManager:
+    """Runs long analyses on a pool of worker processes with no external broker.
+
+    Up to max_workers long-lived workers, each its own interpreter and
+    session, run one job at a time and keep process.py's caches between jobs;
+    a job goes preferably to a worker that already loaded its sample. The rest
+    wait in a local queue. Submitting the same kind and parameters as a queued
+    or running job returns that job; cancelling such a shared job only withdraws
+    one submission until the last one (or a forced cancel). Cancelling a running
+    job kills its worker (and anything it started), which is replaced when
+    needed.
+    """
+
+    def __init__(self, max_workers=JOB_MAX_WORKERS, history=JOB_HISTORY):
+        self.max_workers = max(1, max_workers)
+        self.history = history
+        self._job_dir = None
+        self._jobs = OrderedDict()
+        self._active_keys = {}
+        self._queue = deque()
+        self._running = {}
+        self._workers = []
+        self._changed = threading.Condition()
+        self._dispatcher = None
+        atexit.register(self.shutdown)
+
+    def _start_dispatcher(self):
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._dispatcher = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _update(self, job, **changes):
+        job.update(changes)
+        job["version"] += 1
+        if job["status"] not in ACTIVE_STATES:
+            job["finished_at"] = time.time()
+            if self._active_keys.get(job["key"]) == job["id"]:
+                del self._active_keys[job["key"]]
+            self._trim_history()
+        self._changed.notify_all()
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] not in ACTIVE_STATES]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def submit(self, kind, params):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind '{kind}', expected one of {sorted(JOB_KINDS)}")
+
+        key = f"{kind}:{json.dumps(params, sort_keys=True)}"
+        with self._changed:
+            job_id = self._active_keys.get(key)
+            if job_id is not None:
+                self._jobs[job_id]["submissions"] += 1
+                return self._jobs[job_id]
+
+            job = {
+                "id": uuid.uuid4().hex,
+                "kind": kind,
+                "key": key,
+                "params": params,
+                "status": "queued",
+                "submissions": 1,
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "progress": None,
+                "result": None,
+                "error": None,
+                "version": 0,
+            }
+            self._jobs[job["id"]] = job
+            self._active_keys[key] = job["id"]
+            self._queue.append(job["id"])
+            self._changed.notify_all()
+            self._start_dispatcher()
+            return job
+
+    # cancel every queued and running job (at interpreter exit)
+    def shutdown(self):
+        with self._changed:
+            job_ids = list(self._queue) + list(self._running)
+        for job_id in job_ids:
+            self.cancel(job_id, force=True)
+        with self._changed:
+            for worker in self._workers:
+                self._stop_worker(worker)
+            self._workers = []
+        if self._job_dir is not None:
+            shutil.rmtree(self._job_dir, ignore_errors=True)
+
+    # withdraw one submission of a job; the job itself is cancelled when its
+    # last submitter withdraws, or right away with force
+    def cancel(self, job_id, force=False):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] not in ACTIVE_STATES:
+                return job
+
+            if job["submissions"] > 1 and not force:
+                self._update(job, submissions=job["submissions"] - 1)
+                return job
+
+            if job["status"] == "queued":
+                self._queue.remove(job_id)
+            else:
+                worker, job_path = self._running.pop(job_id)
+                self._stop_worker(worker)
+                self._workers.remove(worker)
+                self._remove(job_path)
+            self._update(job, status="cancelled")
+            return job
+
+    # public view of a job; the result is only included when asked for
+    def describe(self, job, include_result=False):
+        now = time.time()
+        started = job["started_at"]
+        info = {
+            "job_id": job["id"],
+            "kind": job["kind"],
+            "status": job["status"],
+            "submissions": job["submissions"],
+            "submitted_at": job["submitted_at"],
+            "started_at": started,
+            "finished_at": job["finished_at"],
+            "elapsed": ((job["finished_at"] or now) - started) if started else 0.0,
+            "queue_position": list(self._queue).index(job["id"]) + 1 if job["status"] == "queued" else None,
+            "progress": job["progress"],
+            "error": job["error"],
+        }
+        if include_result and job["status"] == "done":
+            info["result"] = job["result"]
+        return info
+
+    def get(self, job_id, include_result=False):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return None if job is None else self.describe(job, include_result)
+
+    def list(self):
+        with self._changed:
+            return [self.describe(job) for job in self._jobs.values()]
+
+    # yield the job's state whenever it changes (and every timeout seconds as
+    # a keep-alive) until it finishes
+    def watch(self, job_id, timeout=15.0):
+        version = None
+        while True:
+            with self._changed:
+                job = self._jobs.get(job_id)
+                if job is not None and job["version"] == version:
+                    self._changed.wait_for(lambda: job["version"] != version, timeout)
+                    job = self._jobs.get(job_id)
+                if job is None:
+                    return
+                version = job["version"]
+                info = self.describe(job, include_result=True)
+
+            yield info
+            if info["status"] not in ACTIVE_STATES:
+                return
+
+    @staticmethod
+    def _remove(job_path):
+        for path in (job_path, job_path + ".out", job_path + ".out.tmp",
+                     job_path + ".progress", job_path + ".progress.tmp"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _start_worker(self):
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE,
+            text=True,
+            start_new_session=True,
+        )
+        worker = {"proc": proc, "job_id": None, "samples": set()}
+        self._workers.append(worker)
+        return worker
+
+    # kill a worker with everything it started (its own process group)
+    @staticmethod
+    def _stop_worker(worker):
+        proc = worker["proc"]
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except (AttributeError, OSError):
+            proc.terminate()
+        proc.wait()
+
+    # an idle worker for the job, preferring one that already loaded its sample;
+    # a new one only when all are busy and the pool is below max_workers
+    def _idle_worker(self, job):
+        self._workers = [
+            worker for worker in self._workers
+            if worker["job_id"] is not None or worker["proc"].poll() is None
+        ]
+        idle = [worker for worker in self._workers if worker["job_id"] is None]
+        sample_id = job["params"].get("sample_id")
+        for worker in idle:
+            if sample_id in worker["samples"]:
+                return worker
+        if idle:
+            return idle[0]
+        if len(self._workers) < self.max_workers:
+            return self._start_worker()
+        return None
+
+    def _start(self, job, worker):
+        if self._job_dir is None:
+            self._job_dir = tempfile.mkdtemp(prefix="biovis-jobs-")
+        job_path = os.path.join(self._job_dir, f"{job['id']}.pkl")
+        with open(job_path, "wb") as f:
+            pickle.dump((JOB_KINDS[job["kind"]], job["params"]), f, protocol=pickle.HIGHEST_PROTOCOL)
+        worker["job_id"] = job["id"]
+        worker["samples"].add(job["params"].get("sample_id"))
+        worker["proc"].stdin.write(job_path + "\n")
+        worker["proc"].stdin.flush()
+        self._running[job["id"]] = (worker, job_path)
+        self._update(job, status="running", started_at=time.time())
+
+    def _finish(self, job_id):
+        worker, job_path = self._running.pop(job_id)
+        worker["job_id"] = None
+        with open(job_path + ".out", "rb") as f:
+            status, result, error = pickle.load(f)
+        self._remove(job_path)
+        self._update(self._jobs[job_id], status=status, result=result, error=error)
+
+    # a worker that died mid-job fails the job and leaves the pool
+    def _lost(self, job_id):
+        worker, job_path = self._running.pop(job_id)
+        self._workers.remove(worker)
+        self._remove(job_path)
+        self._update(
+            self._jobs[job_id],
+            status="failed",
+            error=f"Job worker exited with code {worker['proc'].returncode} without a result",
+        )
+
+    # pick up the latest progress record the job's worker wrote
+    def _read_progress(self, job, job_path):
+        try:
+            with open(job_path + ".progress") as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return
+        if progress != job["progress"]:
+            self._update(job, progress=progress)
+
+    def _dispatch(self):
+        while True:
+            with self._changed:
+                while self._queue:
+                    worker = self._idle_worker(self._jobs[self._queue[0]])
+                    if worker is None:
+                        break
+                    self._start(self._jobs[self._queue.popleft()], worker)
+
+                for job_id, (worker, job_path) in list(self._running.items()):
+                    self._read_progress(self._jobs[job_id], job_path)
+                    if os.path.exists(job_path + ".out"):
+                        self._finish(job_id)
+                    elif worker["proc"].poll() is not None:
+                        self._lost(job_id)
+
+                self._changed.wait(0.2 if self._running else 1.0)
+
+
+job_manager = JobManager()
+
+
+if __name__ == "__main__":
+    _worker()
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file, stream_with_context
 from flask_cors import CORS
 import re
 import os
@@ -9,26 +9,41 @@ from process import (
     get_hires_image_size,
     get_unique_cell_types,
     get_cell_type_coordinates,
+    get_cell_type_coordinates_columnar,
+    get_cells_in_viewport,
+    select_cells,
     get_samples,
     get_cell_types,
     get_gene_list,
     get_gene_list_for_cell2cellinteraction,
     get_kosara_data,
     get_selected_region_data,
+    iter_selected_region_data,
+    iter_cell_type_coordinates,
     get_NMF_GO_data,
-    get_cell_cell_interaction_data
+    get_cell_cell_interaction_data,
+    get_sample_cache_stats,
+    get_kosara_cache_stats,
+    get_nmf_go_cache_stats,
+    invalidate_nmf_go_cache,
+    get_deaplog_results
     # get_umap_positions_with_clusters,
     # get_gene_list,
     # get_specific_gene_expression
 )
 from biobert_service import biobert_service
 from gemini_service import gemini_service
+from jobs import job_manager, JOB_KINDS
+import process
+import inspect
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scanpy as sc
 import sys
 from functools import lru_cache
 import time
+import numpy as np
+import pyarrow as pa
 
 # Add the Python directory to the system path for importing DEAPLOG module
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'Python'))
@@ -45,6 +60,70 @@ CORS(app)  # Enable CORS for all routes
 # Ensure static directories exist for storing figures
 os.makedirs(os.path.join(app.static_folder, 'figures'), exist_ok=True)
 
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+def wants_arrow():
+    """Whether the client asked for Arrow IPC rather than JSON (JSON wins ties such as */*)"""
+    best = request.accept_mimetypes.best_match(['application/json', ARROW_STREAM_MIMETYPE])
+    return best == ARROW_STREAM_MIMETYPE
+
+def arrow_response(columnar):
+    """Encode {sample_id: {column: values}} as one Arrow IPC stream with a sample_id column.
+
+    A "<name>_categories" entry turns the integer codes in "<name>" into a
+    dictionary-encoded column (negative codes become nulls).
+    """
+    tables = []
+    for sample_id, columns in columnar.items():
+        arrays = {}
+        for name, values in columns.items():
+            if name.endswith('_categories'):
+                continue
+            categories = columns.get(f'{name}_categories')
+            if categories is not None:
+                codes = np.asarray(values, dtype=np.int32)
+                arrays[name] = pa.DictionaryArray.from_arrays(
+                    pa.array(codes, mask=codes < 0), pa.array(categories, type=pa.string())
+                )
+            else:
+                arrays[name] = pa.array(values)
+        n_rows = len(next(iter(arrays.values()))) if arrays else 0
+        arrays = {
+            'sample_id': pa.DictionaryArray.from_arrays(
+                pa.array(np.zeros(n_rows, dtype=np.int32)), pa.array([sample_id], type=pa.string())
+            ),
+            **arrays,
+        }
+        tables.append(pa.table(arrays))
+
+    table = pa.concat_tables(tables).unify_dictionaries() if tables else pa.table({})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    response = Response(sink.getvalue().to_pybytes(), mimetype=ARROW_STREAM_MIMETYPE)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+def wants_ndjson():
+    """Whether the client asked for a streamed NDJSON response (Accept header or "stream": true)"""
+    if request.json.get('stream'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+def ndjson_response(chunks):
+    """Stream an iterable of JSON-serializable chunks, one per line, as they are produced"""
+    def generate():
+        for chunk in chunks:
+            yield json.dumps(chunk) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+    response.headers['Vary'] = 'Accept'
+    return response
+
 @app.route('/', methods=['GET'])
 def get_helloword():
     """Basic test endpoint"""
@@ -55,6 +134,27 @@ def get_available_samples():
     """Get list of available samples"""
     return jsonify(get_samples())
 
+@app.route('/get_sample_cache_stats', methods=['GET'])
+def get_sample_cache_stats_route():
+    """Get hit/miss and load-time statistics of the sample cache"""
+    return jsonify(get_sample_cache_stats())
+
+@app.route('/get_kosara_cache_stats', methods=['GET'])
+def get_kosara_cache_stats_route():
+    """Get hit/miss and eviction statistics of the Kosara column cache"""
+    return jsonify(get_kosara_cache_stats())
+
+@app.route('/get_nmf_go_cache_stats', methods=['GET'])
+def get_nmf_go_cache_stats_route():
+    """Get hit/miss, eviction and size statistics of the stored NMF / GO results"""
+    return jsonify(get_nmf_go_cache_stats())
+
+@app.route('/invalidate_nmf_go_cache', methods=['POST'])
+def invalidate_nmf_go_cache_route():
+    """Delete the stored NMF / GO results of one sample (or of all samples if no sample_id is given)"""
+    sample_id = (request.get_json(silent=True) or {}).get('sample_id')
+    return jsonify({"removed": invalidate_nmf_go_cache(sample_id)})
+
 @app.route('/get_hires_image_size', methods=['POST'])
 def get_hires_image_size_route():
     """Get high-resolution image size for selected samples"""
@@ -87,9 +187,32 @@ def serve_tile():
 
 @app.route('/get_cell_type_coordinates', methods=['POST'])
 def get_cell_type_coordinates_route():
-    """Get cell type coordinates for selected samples"""
+    """Get cell type coordinates for selected samples (Arrow IPC or streamed NDJSON if requested, else JSON)"""
     sample_ids = request.json['sample_ids']
-    return jsonify(get_cell_type_coordinates(sample_ids))
+    if wants_arrow():
+        return arrow_response(get_cell_type_coordinates_columnar(sample_ids))
+    if wants_ndjson():
+        chunk_size = int(request.json.get('chunk_size', 50000))
+        return ndjson_response(iter_cell_type_coordinates(sample_ids, chunk_size=chunk_size))
+    response = jsonify(get_cell_type_coordinates(sample_ids))
+    response.headers['Vary'] = 'Accept'
+    return response
+
+@app.route('/get_cells_in_viewport', methods=['POST'])
+def get_cells_in_viewport_route():
+    """Get the cells inside a viewport, decimated by cell type at low zoom levels"""
+    sample_id = request.json['sample_id']
+    bbox = request.json['bbox']
+    zoom = float(request.json['zoom'])
+    if wants_arrow():
+        result = get_cells_in_viewport(sample_id, bbox, zoom, columnar=True)
+        response = arrow_response({sample_id: result['cells']})
+        response.headers['X-LOD-Level'] = str(result['level'])
+        response.headers['X-LOD-Complete'] = str(result['complete']).lower()
+        return response
+    response = jsonify(get_cells_in_viewport(sample_id, bbox, zoom))
+    response.headers['Vary'] = 'Accept'
+    return response
 
 @app.route('/get_cell_types', methods=['POST'])
 def get_cell_types_route():
@@ -109,27 +232,60 @@ def get_cell2cell_gene_list_route():
     sample_name = request.json['sample_name']
     return jsonify(get_gene_list_for_cell2cellinteraction(sample_name))
 
+@app.route('/get_cells_in_selection', methods=['POST'])
+def get_cells_in_selection_route():
+    """Get the ids of the cells inside a bbox / polygon / circle selection"""
+    sample_id = request.json['sample_id']
+    selection = request.json['selection']
+    return jsonify({'cell_ids': select_cells(sample_id, selection)})
+
 @app.route('/get_kosara_data', methods=['POST'])
 def get_kosara_data_route():
-    """Get Kosara visualization data"""
+    """Get Kosara visualization data for a cell list, a region selection or a list of named regions
+    (columnar Arrow IPC if requested, else JSON)"""
     sample_ids = request.json['sample_ids']
     gene_list = request.json['gene_list']
-    cell_list = request.json['cell_list']
-    return jsonify(get_kosara_data(sample_ids, gene_list, cell_list))
+    cell_list = request.json.get('cell_list', [])
+    selection = request.json.get('selection')
+    regions = request.json.get('regions')
+    if wants_arrow():
+        return arrow_response(get_kosara_data(sample_ids, gene_list, cell_list, selection=selection, columnar=True, regions=regions))
+    response = jsonify(get_kosara_data(sample_ids, gene_list, cell_list, selection=selection, regions=regions))
+    response.headers['Vary'] = 'Accept'
+    return response
 
 @app.route('/get_selected_region_data', methods=['POST'])
 def get_selected_region_data_route():
-    """Get gene expressiondata for selected regions"""
+    """Get gene expressiondata for selected regions (cell list or region selection), dense, as CSR or streamed"""
     sample_id = request.json['sample_id']
-    cell_list = request.json['cell_list']
-    return jsonify(get_selected_region_data(sample_id, cell_list))
+    cell_list = request.json.get('cell_list', [])
+    selection = request.json.get('selection')
+    format = request.json.get('format', 'dense')
+    try:
+        if wants_ndjson():
+            chunk_size = int(request.json.get('chunk_size', 1000))
+            return ndjson_response(iter_selected_region_data(sample_id, cell_list, selection=selection, chunk_size=chunk_size))
+        return jsonify(get_selected_region_data(sample_id, cell_list, selection=selection, format=format))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 @app.route('/get_NMF_GO_data', methods=['POST'])
 def get_NMF_GO_data_route():
-    """Get NMF GO data"""
+    """Get NMF GO data for a cell list or a region selection"""
     sample_id = request.json['sample_id']
-    cell_list = request.json['cell_list']
-    return jsonify(get_NMF_GO_data(sample_id, cell_list))
+    cell_list = request.json.get('cell_list', [])
+    selection = request.json.get('selection')
+    options = {
+        key: request.json[key]
+        for key in ('n_top_genes', 'min_detection_rate', 'metacell_size')
+        if request.json.get(key) is not None
+    }
+    if request.json.get('async'):
+        return submit_job('NMF_GO', {'sample_id': sample_id, 'cell_list': cell_list, 'selection': selection, **options})
+    try:
+        return jsonify(get_NMF_GO_data(sample_id, cell_list, selection=selection, **options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 @app.route('/get_cell_cell_interaction_data', methods=['POST'])
 def get_cell_cell_interaction_data_route():
@@ -139,8 +295,109 @@ def get_cell_cell_interaction_data_route():
     sender = request.json['sender']
     receiverGene = request.json['receiverGene']
     senderGene = request.json['senderGene']
-    cellIds = request.json['cellIds']
-    return jsonify(get_cell_cell_interaction_data(sample_id, receiver, sender, receiverGene, senderGene, cellIds))
+    cellIds = request.json.get('cellIds', [])
+    selection = request.json.get('selection')
+    engine = request.json.get('engine', 'spacia')
+    if request.json.get('async'):
+        return submit_job('cell_cell_interaction', {
+            'sample_id': sample_id,
+            'receiver': receiver,
+            'sender': sender,
+            'receiverGene': receiverGene,
+            'senderGene': senderGene,
+            'cellIds': cellIds,
+            'selection': selection,
+            'engine': engine,
+        })
+    try:
+        return jsonify(get_cell_cell_interaction_data(sample_id, receiver, sender, receiverGene, senderGene, cellIds,
+                                                      selection=selection, engine=engine))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@lru_cache(maxsize=10)
+def get_cached_deaplog_results(sample_percent, step):
+    """Cached version of DEAPLOG results"""
+    return get_deaplog_results(sample_percent, step)
+
+@app.route('/get_deaplog_results', methods=['GET'])
+def get_deaplog_results_route():
+    """Get DEAPLOG results (submitted as a job with ?async=1)"""
+    sample_percent = request.args.get('sample_percent', default=0.01, type=float)
+    step = request.args.get('step', default=0, type=int)
+    if request.args.get('async', default=False, type=lambda value: value.lower() in ('1', 'true', 'yes')):
+        return submit_job('deaplog', {'sample_percent': sample_percent, 'step': step})
+    try:
+        return jsonify(get_cached_deaplog_results(sample_percent, step))
+    except Exception as e:
+        error_msg = f'Error running DEAPLOG: {str(e)}'
+        print(f"Error: {error_msg}")
+        return jsonify({'error': error_msg}), 500
+
+#################### JOBS ####################
+def submit_job(kind, params):
+    """Queue an analysis as a job (or join an identical active one) and return its id"""
+    if kind not in JOB_KINDS:
+        return jsonify({'error': f"Unknown job kind '{kind}', expected one of {sorted(JOB_KINDS)}"}), 400
+    try:
+        inspect.signature(getattr(process, JOB_KINDS[kind])).bind(**params)
+    except TypeError as e:
+        return jsonify({'error': f'Invalid parameters for {kind}: {str(e)}'}), 400
+
+    job = job_manager.submit(kind, params)
+    response = jsonify(job_manager.get(job['id']))
+    response.status_code = 202
+    response.headers['Location'] = f"/jobs/{job['id']}"
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_route():
+    """Submit a long-running analysis ({"kind": ..., "params": {...}}) and return its job id"""
+    return submit_job(request.json.get('kind'), request.json.get('params') or {})
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs_route():
+    """List queued, running and recently finished jobs"""
+    return jsonify(job_manager.list())
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_route(job_id):
+    """Get a job's status, and its result once it is done"""
+    job = job_manager.get(job_id, include_result=True)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events_route(job_id):
+    """Server-sent events with the job's state on every change (a "progress" event
+    when only its progress changed), ending with its result"""
+    if job_manager.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        last = None
+        for state in job_manager.watch(job_id):
+            if last is not None and state['status'] == last['status'] and state['progress'] != last['progress']:
+                event = 'progress'
+            else:
+                event = state['status']
+            last = state
+            yield f"event: {event}\ndata: {json.dumps(state)}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job_route(job_id):
+    """Cancel a queued or running job; a job shared by identical submissions is only
+    cancelled once every submitter has cancelled it, or right away with ?force=1"""
+    force = request.args.get('force', '').lower() in ('1', 'true', 'yes')
+    job = job_manager.cancel(job_id, force=force)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_manager.get(job_id))
 
 #################### OLD CODE ####################
 @app.route('/get_um_positions_with_clusters', methods=['POST'])
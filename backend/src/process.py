@@ -1,24 +1,55 @@
 import numpy as np
 import pandas as pd
 import os
+import threading
+import hashlib
+import json
+import pickle
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from scipy.optimize import fsolve
 import anndata as ad
 import scanpy as sc
 from PIL import Image
 import tifffile as tifi
 import squidpy as sq
-import gseapy as gp
-from scipy.sparse import issparse
-from sklearn.decomposition import NMF
+from scipy.sparse import issparse, csr_matrix, coo_matrix
+import h5py
+from sklearn.decomposition import NMF, MiniBatchNMF, TruncatedSVD
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy.cluster.hierarchy import linkage, cophenet
 from sklearn.metrics import silhouette_score
 from scipy.spatial.distance import pdist
+from scipy.spatial import cKDTree
+from scipy.stats import hypergeom
+from matplotlib.path import Path
+from umap.umap_ import fuzzy_simplicial_set
 
 hirescalef = 0.10757315
 
+# progress of a long analysis: its stage, and steps done / total where known.
+# Reports go to the reporter a job worker sets and are ignored otherwise
+_progress_reporter = None
+
+
+def set_progress_reporter(reporter):
+    global _progress_reporter
+    _progress_reporter = reporter
+
+
+def report_progress(stage, done=None, total=None):
+    if _progress_reporter is not None:
+        _progress_reporter({"stage": stage, "done": done, "total": total})
+
 SAMPLES = {
     "skin_TXK6Z4X_A1": {
         "id": "skin_TXK6Z4X_A1",
@@ -27,6 +58,7 @@ SAMPLES = {
         "wsi": "../Data/skin_TXK6Z4X_A1_processed/tmap/wsi.tif",
         "tiles": "../Data/skin_TXK6Z4X_A1_processed/skin_TXK6Z4X_A1_processed_tiles",
         "cells_layer": "../Data/skin_TXK6Z4X_A1_processed/cells_layer.png",
+        "backed": False,
     },
     "skin_TXK6Z4X_D1": {
         "id": "skin_TXK6Z4X_D1",
@@ -35,10 +67,379 @@ SAMPLES = {
         "wsi": "../Data/skin_TXK6Z4X_D1_processed/tmap/wsi.tif",
         "tiles": "../Data/skin_TXK6Z4X_D1_processed/skin_TXK6Z4X_D1_processed_tiles",
         "cells_layer": "../Data/skin_TXK6Z4X_D1_processed/cells_layer.png",
+        "backed": False,
     },
 }
 
 
+# sample cache budget in bytes (0 = unlimited); when exceeded, least recently
+# used samples are evicted, or reopened in backed mode if SAMPLE_CACHE_BACKED_FALLBACK is set
+SAMPLE_CACHE_MAX_BYTES = int(os.getenv("SAMPLE_CACHE_MAX_BYTES", "0"))
+SAMPLE_CACHE_BACKED_FALLBACK = os.getenv("SAMPLE_CACHE_BACKED_FALLBACK", "0").lower() in ("1", "true", "yes")
+
+
+# process-wide registry of loaded samples: each h5ad is read once and shared
+# read-only across requests and threads, and reloaded when the file changes
+class SampleRegistry:
+    def __init__(self, max_bytes=SAMPLE_CACHE_MAX_BYTES, backed_fallback=SAMPLE_CACHE_BACKED_FALLBACK):
+        self.max_bytes = max_bytes
+        self.backed_fallback = backed_fallback
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def _lookup(self, sample_id, path, mtime):
+        entry = self._entries.get(sample_id)
+        if entry is not None and entry["path"] == path and entry["mtime"] == mtime:
+            self._entries.move_to_end(sample_id)
+            self.hits += 1
+            entry["hits"] += 1
+            return entry
+        return None
+
+    def get(self, sample_id):
+        sample_info = SAMPLES.get(sample_id)
+        if not sample_info:
+            raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
+
+        path = sample_info["adata"]
+        mtime = os.path.getmtime(path)
+
+        with self._lock:
+            entry = self._lookup(sample_id, path, mtime)
+            if entry is not None:
+                return entry["adata"]
+            load_lock = self._load_locks.setdefault(sample_id, threading.Lock())
+
+        # one loader per sample, concurrent requests wait for it instead of reading again
+        with load_lock:
+            with self._lock:
+                entry = self._lookup(sample_id, path, mtime)
+                if entry is not None:
+                    return entry["adata"]
+                stale = sample_id in self._entries
+
+            # samples flagged "backed" in SAMPLES keep their expression matrix on disk
+            backed = bool(sample_info.get("backed", False))
+            start = time.perf_counter()
+            adata = sc.read_h5ad(path, backed="r" if backed else None)
+            _make_read_only(adata)
+            elapsed = time.perf_counter() - start
+            print(f"Loaded sample {sample_id} in {elapsed:.2f}s")
+
+            with self._lock:
+                self.misses += 1
+                self.load_time += elapsed
+                if stale:
+                    self.reloads += 1
+                self._entries[sample_id] = {
+                    "adata": adata,
+                    "path": path,
+                    "mtime": mtime,
+                    "nbytes": _estimate_adata_bytes(adata),
+                    "backed": backed,
+                    "load_time": elapsed,
+                    "loaded_at": time.time(),
+                    "hits": 0,
+                }
+                self._entries.move_to_end(sample_id)
+                self._enforce_budget(keep=sample_id)
+            return adata
+
+    def _total_bytes(self):
+        return sum(entry["nbytes"] for entry in self._entries.values())
+
+    # evict least recently used samples until the budget holds; in-memory samples are
+    # first demoted to backed mode (if enabled), backed ones are then dropped
+    def _enforce_budget(self, keep):
+        if not self.max_bytes:
+            return
+
+        for demote in (True, False):
+            for sample_id in list(self._entries):
+                if self._total_bytes() <= self.max_bytes:
+                    return
+                if sample_id == keep:
+                    continue
+                entry = self._entries[sample_id]
+                if demote and (entry["backed"] or not self.backed_fallback):
+                    continue
+                if demote:
+                    entry["adata"] = ad.read_h5ad(entry["path"], backed="r")
+                    entry["nbytes"] = _estimate_adata_bytes(entry["adata"])
+                    entry["backed"] = True
+                    print(f"Sample {sample_id} moved to backed mode")
+                else:
+                    del self._entries[sample_id]
+                    print(f"Sample {sample_id} evicted from cache")
+                self.evictions += 1
+
+    def clear(self, sample_id=None):
+        with self._lock:
+            if sample_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(sample_id, None)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "total_load_time": self.load_time,
+                "bytes": self._total_bytes(),
+                "max_bytes": self.max_bytes,
+                "samples": {
+                    sample_id: {
+                        "hits": entry["hits"],
+                        "bytes": entry["nbytes"],
+                        "backed": entry["backed"],
+                        "load_time": entry["load_time"],
+                        "loaded_at": entry["loaded_at"],
+                        "mtime": entry["mtime"],
+                    }
+                    for sample_id, entry in self._entries.items()
+                },
+            }
+
+
+# approximate resident size of a sample from X, obs and obsm
+def _estimate_adata_bytes(adata):
+    def array_bytes(value):
+        if issparse(value):
+            return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(deep=True).sum())
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        return 0
+
+    nbytes = 0 if adata.isbacked else array_bytes(adata.X)
+    nbytes += int(adata.obs.memory_usage(deep=True).sum())
+    nbytes += sum(array_bytes(value) for value in adata.obsm.values())
+    return nbytes
+
+
+# copy a (possibly backed) view into an independent in-memory AnnData
+def _materialize(view):
+    if view.isbacked:
+        return view.to_memory()
+    return view.copy()
+
+
+# dense expression of the given cells x genes; for backed samples only the
+# requested rows or columns are read from disk instead of the whole matrix
+def _read_expression(adata, cell_idx, gene_idx):
+    cell_idx = np.asarray(cell_idx, dtype=np.int64)
+    gene_idx = np.asarray(gene_idx, dtype=np.int64)
+
+    if not adata.isbacked:
+        X = adata.X[cell_idx][:, gene_idx]
+        return X.toarray() if issparse(X) else np.asarray(X)
+
+    X = adata.X
+    if len(cell_idx) == 0 or len(gene_idx) == 0:
+        return np.zeros((len(cell_idx), len(gene_idx)), dtype=X.dtype)
+
+    # h5py reads need sorted, unique indices, and only one index list per read
+    rows, row_pos = np.unique(cell_idx, return_inverse=True)
+    cols, col_pos = np.unique(gene_idx, return_inverse=True)
+    if isinstance(X, h5py.Dataset):
+        if len(cols) * adata.n_obs <= len(rows) * adata.n_vars:
+            block = X[:, cols][rows]
+        else:
+            block = X[rows, :][:, cols]
+    else:
+        block = X[rows][:, cols].toarray()
+    return block[row_pos][:, col_pos]
+
+
+# total expression of the given cells, read chunk by chunk when the sample is backed
+def _row_sums(adata, cell_idx, chunk_size=10000):
+    cell_idx = np.asarray(cell_idx, dtype=np.int64)
+
+    if not adata.isbacked:
+        return np.asarray(adata.X[cell_idx].sum(axis=1)).ravel()
+
+    rows, row_pos = np.unique(cell_idx, return_inverse=True)
+    sums = np.zeros(len(rows), dtype=adata.X.dtype)
+    for start in range(0, len(rows), chunk_size):
+        chunk = adata.X[rows[start:start + chunk_size]]
+        sums[start:start + chunk_size] = np.asarray(chunk.sum(axis=1)).ravel()
+    return sums[row_pos]
+
+
+# per-gene sums over all cells, read chunk by chunk when the sample is backed
+def _gene_sums(adata, chunk_size=10000):
+    if not adata.isbacked:
+        return np.asarray(adata.X.sum(axis=0)).ravel()
+
+    sums = np.zeros(adata.n_vars)
+    for chunk, _, _ in adata.chunked_X(chunk_size):
+        sums += np.asarray(chunk.sum(axis=0)).ravel()
+    return sums
+
+
+# shared samples must not be modified in place by a request
+def _make_read_only(adata):
+    X = adata.X
+    if issparse(X):
+        for arr in (X.data, X.indices, X.indptr):
+            arr.setflags(write=False)
+    elif isinstance(X, np.ndarray):
+        X.setflags(write=False)
+
+
+sample_registry = SampleRegistry()
+
+
+# per-sample sidecar index with precomputed metadata, written offline by
+# `python cli.py build-index` next to the h5ad (or at SAMPLES[...]["index"])
+SAMPLE_INDEX_VERSION = 1
+_sample_indexes = {}
+_sample_indexes_lock = threading.Lock()
+
+
+def _sample_index_dir(sample_info):
+    return sample_info.get("index", sample_info["adata"] + ".index")
+
+
+# sha256 of a file, read in blocks
+def _file_checksum(path, block_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# per-gene and per-cell sums in a single pass over the expression matrix
+def _expression_sums(adata, chunk_size=10000):
+    gene_sums = np.zeros(adata.n_vars)
+    cell_sums = np.zeros(adata.n_obs)
+    for chunk, start, end in adata.chunked_X(chunk_size):
+        gene_sums += np.asarray(chunk.sum(axis=0)).ravel()
+        cell_sums[start:end] = np.asarray(chunk.sum(axis=1)).ravel()
+    return gene_sums, cell_sums
+
+
+# write the sidecar index of a sample; the source is opened backed so that
+# slides larger than memory can be indexed
+def build_sample_index(sample_id, force=False):
+    sample_info = SAMPLES.get(sample_id)
+    if not sample_info:
+        raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
+
+    if not force and get_sample_index(sample_id) is not None:
+        print(f"Index for {sample_id} is up to date")
+        return _sample_index_dir(sample_info)
+
+    path = sample_info["adata"]
+    stat = os.stat(path)
+    start = time.perf_counter()
+    adata = sc.read_h5ad(path, backed="r")
+
+    cell_types = pd.Categorical(adata.obs["cell_type"])
+    spatial = adata.obsm["spatial"]
+    if isinstance(spatial, pd.DataFrame):
+        spatial_columns = [str(col) for col in spatial.columns]
+        spatial = spatial.to_numpy()
+    else:
+        spatial_columns = ["cell_x", "cell_y"]
+    gene_sums, cell_sums = _expression_sums(adata)
+
+    index_dir = _sample_index_dir(sample_info)
+    tmp_dir = index_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, "cell_ids.npy"), adata.obs_names.to_numpy(dtype=str))
+    np.save(os.path.join(tmp_dir, "cell_type_codes.npy"), cell_types.codes)
+    np.save(os.path.join(tmp_dir, "gene_names.npy"), adata.var_names.to_numpy(dtype=str))
+    np.save(os.path.join(tmp_dir, "gene_sums.npy"), gene_sums)
+    np.save(os.path.join(tmp_dir, "total_expression.npy"), cell_sums)
+    np.save(os.path.join(tmp_dir, "spatial.npy"), np.asarray(spatial, dtype=np.float64))
+
+    manifest = {
+        "version": SAMPLE_INDEX_VERSION,
+        "sample_id": sample_id,
+        "source": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": _file_checksum(path),
+        "n_obs": adata.n_obs,
+        "n_vars": adata.n_vars,
+        "cell_type_categories": [str(ct) for ct in cell_types.categories],
+        "unique_cell_types": [str(ct) for ct in adata.obs["cell_type"].unique()],
+        "spatial_columns": spatial_columns,
+        "created": time.time(),
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    adata.file.close()
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    print(f"Built index for {sample_id} in {time.perf_counter() - start:.2f}s: {index_dir}")
+    return index_dir
+
+
+# return the sidecar index of a sample, or None when it is missing or does
+# not match the current h5ad (callers then fall back to the full sample)
+def get_sample_index(sample_id):
+    sample_info = SAMPLES.get(sample_id)
+    if not sample_info:
+        return None
+
+    index_dir = _sample_index_dir(sample_info)
+    manifest_path = os.path.join(index_dir, "manifest.json")
+    try:
+        stat = os.stat(sample_info["adata"])
+        manifest_mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return None
+
+    with _sample_indexes_lock:
+        cached = _sample_indexes.get(sample_id)
+        if cached is not None and cached["key"] == (index_dir, manifest_mtime, stat.st_size, stat.st_mtime):
+            return cached["index"]
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if (
+        manifest.get("version") != SAMPLE_INDEX_VERSION
+        or manifest["size"] != stat.st_size
+        or manifest["mtime"] != stat.st_mtime
+    ):
+        print(f"Index for {sample_id} is stale, run `python cli.py build-index {sample_id}`")
+        return None
+
+    index = dict(manifest)
+    for name in ("cell_ids", "cell_type_codes", "gene_names", "gene_sums", "total_expression", "spatial"):
+        index[name] = np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+
+    with _sample_indexes_lock:
+        _sample_indexes[sample_id] = {
+            "key": (index_dir, manifest_mtime, stat.st_size, stat.st_mtime),
+            "index": index,
+        }
+    return index
+
+
+# return sample cache statistics
+def get_sample_cache_stats():
+    return sample_registry.stats()
+
+
 # return sample list
 def get_samples():
     return [
@@ -46,15 +447,47 @@ def get_samples():
     ]
 
 
+_image_sizes = {}
+_image_sizes_lock = threading.Lock()
+
+
+# width and height of a slide read from its TIFF header (no pixel data is
+# decoded), cached per file mtime
+def _read_image_size(path):
+    mtime = os.path.getmtime(path)
+    with _image_sizes_lock:
+        cached = _image_sizes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    try:
+        with tifi.TiffFile(path) as tif:
+            page = tif.pages[0]
+            size = (int(page.imagewidth), int(page.imagelength))
+    except tifi.TiffFileError:
+        # not a TIFF, PIL also only parses the header on open
+        Image.MAX_IMAGE_PIXELS = None
+        with Image.open(path) as image:
+            size = image.size
+
+    with _image_sizes_lock:
+        _image_sizes[path] = (mtime, size)
+    return size
+
+
 # return tissue width and height size
 def get_hires_image_size(sample_ids):
-    Image.MAX_IMAGE_PIXELS = None
     sizes = {}
 
-    for sample_id in sample_ids:
-        if sample_id in SAMPLES:
-            image = Image.open(SAMPLES[sample_id]["wsi"])
-        sizes[sample_id] = image.size
+    for sample_id in dict.fromkeys(sample_ids):
+        sample_info = SAMPLES.get(sample_id)
+        if not sample_info:
+            continue
+
+        try:
+            sizes[sample_id] = _read_image_size(sample_info["wsi"])
+        except Exception as e:
+            print(f"Failed to read image size of {sample_info['wsi']}: {str(e)}")
 
     return sizes
 
@@ -65,7 +498,11 @@ def get_unique_cell_types(sample_ids):
 
     for sample_id in sample_ids:
         if sample_id in SAMPLES:
-            adata = sc.read_h5ad(SAMPLES[sample_id]["adata"])
+            index = get_sample_index(sample_id)
+            if index is not None:
+                result[sample_id] = list(index["unique_cell_types"])
+                continue
+            adata = sample_registry.get(sample_id)
             result[sample_id] = adata.obs["cell_type"].unique().tolist()
 
     return result
@@ -77,23 +514,278 @@ def get_cell_type_coordinates(sample_ids):
 
     for sample_id in sample_ids:
         if sample_id in SAMPLES:
-            adata = sc.read_h5ad(SAMPLES[sample_id]["adata"])
-            df = adata.obsm["spatial"].copy()
-            df["cell_type"] = adata.obs["cell_type"]
-            df["id"] = adata.obs.index
+            index = get_sample_index(sample_id)
+            if index is not None:
+                df = pd.DataFrame(np.asarray(index["spatial"]), columns=index["spatial_columns"])
+                df["cell_type"] = pd.Categorical.from_codes(
+                    index["cell_type_codes"], index["cell_type_categories"]
+                )
+                df["id"] = np.asarray(index["cell_ids"], dtype=object)
+            else:
+                adata = sample_registry.get(sample_id)
+                df = adata.obsm["spatial"].copy()
+                df["cell_type"] = adata.obs["cell_type"]
+                df["id"] = adata.obs.index
             result[sample_id] = df.to_dict(orient="records")
 
     return result
 
 
+# coordinates, cell type codes and categories, and ids of all cells of a
+# sample, from the sidecar index when available
+def _cell_table(sample_id):
+    index = get_sample_index(sample_id)
+    if index is not None:
+        return (
+            np.asarray(index["spatial"]),
+            np.asarray(index["cell_type_codes"]),
+            list(index["cell_type_categories"]),
+            np.asarray(index["cell_ids"]),
+        )
+
+    adata = sample_registry.get(sample_id)
+    cell_types = pd.Categorical(adata.obs["cell_type"])
+    return (
+        np.asarray(adata.obsm["spatial"]),
+        cell_types.codes,
+        [str(ct) for ct in cell_types.categories],
+        adata.obs_names.to_numpy(dtype=str),
+    )
+
+
+# stream cell types and coordinates in chunks of at most chunk_size cells per sample
+def iter_cell_type_coordinates(sample_ids, chunk_size=50000):
+    for sample_id in sample_ids:
+        if sample_id not in SAMPLES:
+            continue
+
+        spatial, codes, categories, ids = _cell_table(sample_id)
+        for start in range(0, len(ids), chunk_size):
+            end = start + chunk_size
+            df = pd.DataFrame({
+                "cell_x": spatial[start:end, 0],
+                "cell_y": spatial[start:end, 1],
+                "cell_type": pd.Categorical.from_codes(codes[start:end], categories),
+                "id": ids[start:end].astype(object),
+            })
+            yield {"sample_id": sample_id, "cells": df.to_dict(orient="records")}
+
+
+# return cell type, and cell coordinates as columns: float32 coordinates,
+# cell type codes with their categories, and cell ids
+def get_cell_type_coordinates_columnar(sample_ids):
+    result = {}
+
+    for sample_id in sample_ids:
+        if sample_id not in SAMPLES:
+            continue
+
+        spatial, codes, categories, ids = _cell_table(sample_id)
+        result[sample_id] = {
+            "id": ids,
+            "cell_x": spatial[:, 0].astype(np.float32),
+            "cell_y": spatial[:, 1].astype(np.float32),
+            "cell_type": codes,
+            "cell_type_categories": categories,
+        }
+
+    return result
+
+
+_spatial_indexes = {}
+_spatial_indexes_lock = threading.Lock()
+
+
+# per-sample KD-tree over the cell coordinates, rebuilt when the h5ad changes
+def _get_spatial_index(sample_id):
+    sample_info = SAMPLES.get(sample_id)
+    if not sample_info:
+        raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
+
+    mtime = os.path.getmtime(sample_info["adata"])
+    with _spatial_indexes_lock:
+        cached = _spatial_indexes.get(sample_id)
+        if cached is not None and cached["mtime"] == mtime:
+            return cached
+
+    index = get_sample_index(sample_id)
+    if index is not None:
+        coords = np.asarray(index["spatial"], dtype=np.float64)[:, :2]
+        cell_ids = np.asarray(index["cell_ids"])
+        codes = np.asarray(index["cell_type_codes"])
+        categories = list(index["cell_type_categories"])
+    else:
+        adata = sample_registry.get(sample_id)
+        coords = np.asarray(adata.obsm["spatial"], dtype=np.float64)[:, :2]
+        cell_ids = adata.obs_names.to_numpy(dtype=str)
+        cell_types = pd.Categorical(adata.obs["cell_type"])
+        codes = cell_types.codes
+        categories = [str(ct) for ct in cell_types.categories]
+
+    spatial_index = {
+        "mtime": mtime,
+        "coords": coords,
+        "cell_ids": cell_ids,
+        "cell_type_codes": codes,
+        "cell_type_categories": categories,
+        "tree": cKDTree(coords),
+        "pyramid": None,
+    }
+    with _spatial_indexes_lock:
+        _spatial_indexes[sample_id] = spatial_index
+    return spatial_index
+
+
+# cells within a radius of a point, as a boolean mask over all cells
+def _query_ball(spatial_index, center, radius):
+    mask = np.zeros(len(spatial_index["coords"]), dtype=bool)
+    mask[spatial_index["tree"].query_ball_point(center, radius)] = True
+    return mask
+
+
+# resolve a region selection to the sorted positions of the cells it contains;
+# coordinates are in the sample's obsm["spatial"] space. Supported shapes:
+#   {"type": "bbox", "bbox": [xmin, ymin, xmax, ymax]}
+#   {"type": "circle", "center": [x, y], "radius": r}
+#   {"type": "polygon", "points": [[x, y], ...]}
+# a list of shapes selects their union
+def select_cell_indices(sample_id, selection):
+    spatial_index = _get_spatial_index(sample_id)
+    coords = spatial_index["coords"]
+
+    shapes = selection if isinstance(selection, list) else [selection]
+    mask = np.zeros(len(coords), dtype=bool)
+
+    for shape in shapes:
+        shape_type = shape.get("type")
+        if shape_type == "circle":
+            mask |= _query_ball(spatial_index, shape["center"], float(shape["radius"]))
+            continue
+
+        if shape_type == "bbox":
+            xmin, ymin, xmax, ymax = map(float, shape["bbox"])
+        elif shape_type == "polygon":
+            points = np.asarray(shape["points"], dtype=np.float64)
+            if len(points) < 3:
+                raise ValueError("A polygon selection needs at least 3 points.")
+            xmin, ymin = points.min(axis=0)
+            xmax, ymax = points.max(axis=0)
+        else:
+            raise ValueError(f"Unknown selection type '{shape_type}'.")
+
+        # the KD-tree narrows the candidates to the shape's bounding circle
+        center = [(xmin + xmax) / 2, (ymin + ymax) / 2]
+        half_diagonal = np.hypot(xmax - xmin, ymax - ymin) / 2
+        candidates = np.flatnonzero(_query_ball(spatial_index, center, half_diagonal))
+        x, y = coords[candidates, 0], coords[candidates, 1]
+        inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        if shape_type == "polygon":
+            inside[inside] = Path(points).contains_points(coords[candidates[inside]])
+        mask[candidates[inside]] = True
+
+    return np.flatnonzero(mask)
+
+
+# resolve a region selection to cell ids
+def select_cells(sample_id, selection):
+    spatial_index = _get_spatial_index(sample_id)
+    return spatial_index["cell_ids"][select_cell_indices(sample_id, selection)].tolist()
+
+
+# level of detail pyramid for viewport streaming: the last level holds every
+# cell and each coarser level keeps about a quarter of the next one (one zoom step)
+LOD_LEVELS = 5
+# viewer zoom from which every cell in the viewport is returned
+LOD_FULL_ZOOM = 0
+
+
+# assign every cell the coarsest pyramid level it appears in; cells are ranked
+# randomly within their cell type so each level keeps every type's share
+# (and at least one cell of each type)
+def _build_point_pyramid(coords, codes, n_levels=LOD_LEVELS, seed=0):
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(codes))
+    order = order[np.argsort(codes[order], kind="stable")]
+    _, starts, counts = np.unique(codes[order], return_index=True, return_counts=True)
+
+    priority = np.empty(len(codes))
+    priority[order] = (np.arange(len(codes)) - np.repeat(starts, counts)) / np.repeat(counts, counts)
+
+    # a cell is in level l when its priority is below 4 ** -(n_levels - 1 - l)
+    with np.errstate(divide="ignore"):
+        cell_level = np.floor(n_levels - 1 + np.log(priority) / np.log(4)) + 1
+    cell_level = np.clip(cell_level, 0, n_levels - 1).astype(np.int8)
+
+    levels = []
+    for level in range(n_levels):
+        cells = np.flatnonzero(cell_level <= level)
+        levels.append({"cells": cells, "tree": cKDTree(coords[cells])})
+    return levels
+
+
+def _get_point_pyramid(sample_id):
+    spatial_index = _get_spatial_index(sample_id)
+    with _spatial_indexes_lock:
+        if spatial_index["pyramid"] is None:
+            spatial_index["pyramid"] = _build_point_pyramid(
+                spatial_index["coords"], spatial_index["cell_type_codes"]
+            )
+    return spatial_index, spatial_index["pyramid"]
+
+
+# return the cells inside a viewport bbox [xmin, ymin, xmax, ymax], decimated
+# by cell type at low zoom and complete from LOD_FULL_ZOOM on
+def get_cells_in_viewport(sample_id, bbox, zoom, columnar=False):
+    spatial_index, pyramid = _get_point_pyramid(sample_id)
+    level = int(np.clip(len(pyramid) - 1 + np.floor(zoom - LOD_FULL_ZOOM), 0, len(pyramid) - 1))
+
+    xmin, ymin, xmax, ymax = map(float, bbox)
+    center = [(xmin + xmax) / 2, (ymin + ymax) / 2]
+    half_diagonal = np.hypot(xmax - xmin, ymax - ymin) / 2
+    candidates = pyramid[level]["cells"][
+        np.sort(pyramid[level]["tree"].query_ball_point(center, half_diagonal)).astype(np.int64)
+    ]
+    x, y = spatial_index["coords"][candidates, 0], spatial_index["coords"][candidates, 1]
+    cells = candidates[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+    codes = spatial_index["cell_type_codes"][cells]
+    categories = spatial_index["cell_type_categories"]
+    if columnar:
+        cells_data = {
+            "id": spatial_index["cell_ids"][cells],
+            "cell_x": spatial_index["coords"][cells, 0].astype(np.float32),
+            "cell_y": spatial_index["coords"][cells, 1].astype(np.float32),
+            "cell_type": codes,
+            "cell_type_categories": categories,
+        }
+    else:
+        cell_types = pd.Categorical.from_codes(codes, categories)
+        cells_data = pd.DataFrame({
+            "cell_x": spatial_index["coords"][cells, 0],
+            "cell_y": spatial_index["coords"][cells, 1],
+            "cell_type": cell_types,
+            "id": spatial_index["cell_ids"][cells].astype(object),
+        }).to_dict(orient="records")
+
+    return {
+        "level": level,
+        "complete": level == len(pyramid) - 1,
+        "cells": cells_data,
+    }
+
+
 # return cell type
 def get_cell_types(sample_id):
     sample_info = SAMPLES.get(sample_id)
     if not sample_info:
         return []
 
-    adata = sc.read_h5ad(sample_info["adata"])
-    cell_types = adata.obs["cell_type"].unique().tolist()
+    index = get_sample_index(sample_id)
+    if index is not None:
+        cell_types = list(index["unique_cell_types"])
+    else:
+        adata = sample_registry.get(sample_id)
+        cell_types = adata.obs["cell_type"].unique().tolist()
 
     return [{"value": ct, "label": ct} for ct in cell_types]
 
@@ -109,9 +801,13 @@ def get_gene_list_for_cell2cellinteraction(sample_id):
     h5ad_path = sample_info.get("adata")
 
     try:
-        adata = sc.read_h5ad(h5ad_path)
+        index = get_sample_index(sample_id)
+        if index is not None:
+            gene_names = index["gene_names"].tolist()
+        else:
+            gene_names = sample_registry.get(sample_id).var_names
 
-        for gene in adata.var_names:
+        for gene in gene_names:
             sample_info_list.append({
                 'value': gene,
                 'label': gene 
@@ -134,14 +830,19 @@ def get_gene_list(sample_names):
 
         h5ad_path = sample_info.get("adata")
 
-        try:
-            adata = sc.read_h5ad(h5ad_path)
-        except Exception as e:
-            print(f"Failed to read {h5ad_path}: {str(e)}")
-            continue
+        index = get_sample_index(sample_name)
+        if index is not None:
+            gene_sums = index["gene_sums"]
+            gene_names = index["gene_names"].tolist()
+        else:
+            try:
+                adata = sample_registry.get(sample_name)
+            except Exception as e:
+                print(f"Failed to read {h5ad_path}: {str(e)}")
+                continue
 
-        gene_sums = adata.X.sum(axis=0)
-        gene_names = adata.var_names
+            gene_sums = _gene_sums(adata)
+            gene_names = adata.var_names
 
         sample_gene_dict[sample_name] = {
             gene: float(gene_sums[i]) for i, gene in enumerate(gene_names)
@@ -150,285 +851,1059 @@ def get_gene_list(sample_names):
     return sample_gene_dict
 
 
-# get kosara data
-def get_kosara_data(sample_ids, gene_list, cell_list):
-    radius = 5
-    d = np.sqrt(2) * radius
+# Kosara glyphs: a gene's share of a cell's total expression (the ratio a) is
+# drawn as the lens where a circle of radius r, centred d = sqrt(2) * radius
+# away, overlaps the cell circle; r is chosen so that the lens covers a of the
+# cell's area, and the glyph angle is the half-angle of the lens at that centre
+KOSARA_RADIUS = 5
 
-    special_r, special_d = np.sqrt(2) * radius, np.sqrt(2) * radius
+
+def _kosara_special_value(radius_val):
+    d = np.sqrt(2) * radius_val
+    special_r = np.sqrt(2) * radius_val
     special_angle1 = np.degrees(
-        np.arccos((special_r**2 + d**2 - radius**2) / (2 * special_r * d))
+        np.arccos((special_r**2 + d**2 - radius_val**2) / (2 * special_r * d))
     )
     special_angle2 = np.degrees(
-        np.arccos((radius**2 + d**2 - special_r**2) / (2 * radius * d))
+        np.arccos((radius_val**2 + d**2 - special_r**2) / (2 * radius_val * d))
     )
     special_result = (
         special_angle1 * special_r**2
-        + special_angle2 * radius**2
+        + special_angle2 * radius_val**2
         - d * special_r * np.sin(special_angle1)
     )
-    special_value = special_result / (np.pi * radius**2)
-
-    def equation(r, d, a, radius_val, special_value):
-        angle1 = np.arccos((r**2 + d**2 - radius_val**2) / (2 * r * d))
-        angle2 = np.arccos((radius_val**2 + d**2 - r**2) / (2 * radius_val * d))
-        if a <= special_value:
-            result = angle1 * r**2 + angle2 * radius_val**2 - d * r * np.sin(angle1)
-        else:
-            result = (
-                angle1 * r**2
-                + angle2 * radius_val**2
-                - r**2 * np.sin(angle1) * np.cos(angle1)
-                - radius_val**2 * np.sin(angle2) * np.cos(angle2)
-            )
-        return result - (a * np.pi * radius_val**2)
-
-    def initial_guess(a, d, special_value):
-        if a <= special_value:
-            return d + 0.01
-        elif a > 0.95:
-            return 8
+    return special_result / (np.pi * radius_val**2)
+
+
+# lens area for radius r minus the target area a * pi * radius^2, element-wise;
+# both branches are the same area written two ways
+def _kosara_equation(r, d, a, radius_val, special_value):
+    angle1 = np.arccos((r**2 + d**2 - radius_val**2) / (2 * r * d))
+    angle2 = np.arccos((radius_val**2 + d**2 - r**2) / (2 * radius_val * d))
+    lens = angle1 * r**2 + angle2 * radius_val**2 - d * r * np.sin(angle1)
+    segments = (
+        angle1 * r**2
+        + angle2 * radius_val**2
+        - r**2 * np.sin(angle1) * np.cos(angle1)
+        - radius_val**2 * np.sin(angle2) * np.cos(angle2)
+    )
+    result = np.where(a <= special_value, lens, segments)
+    return result - (a * np.pi * radius_val**2)
+
+
+# ratio covered by the lens for radii r, on a grid of n radii across
+# [d - radius, d + radius] (cosine spaced, denser near both ends), where it
+# grows monotonically from 0 to 1
+def _kosara_ratio_grid(radius_val, n):
+    d = np.sqrt(2) * radius_val
+    t = np.linspace(0, 1, n)
+    r = d - radius_val + radius_val * (1 - np.cos(np.pi * t))
+    with np.errstate(invalid="ignore"):
+        ratio = _kosara_equation(r, d, 0.0, radius_val, _kosara_special_value(radius_val)) / (np.pi * radius_val**2)
+    ratio[0], ratio[-1] = 0.0, 1.0
+    return r, ratio
+
+
+# solve the Kosara radius and angle (degrees) for an array of ratios in one
+# pass: each ratio is bracketed on a coarse grid of the monotone lens area, then
+# refined with Newton steps (d area / dr = 2 r angle1) that fall back to
+# bisection when they leave the bracket; zero ratios give 0, invalid ones NaN
+def solve_kosara_radius(ratios, radius_val=KOSARA_RADIUS, tol=1e-12, max_iter=100):
+    a = np.asarray(ratios, dtype=np.float64)
+    d = np.sqrt(2) * radius_val
+    special_value = _kosara_special_value(radius_val)
+
+    valid = (a > 0) & (a <= 1)
+    target = a[valid]
+    grid_r, grid_ratio = _kosara_ratio_grid(radius_val, 257)
+    k = np.clip(np.searchsorted(grid_ratio, target), 1, len(grid_ratio) - 1)
+    lo, hi = grid_r[k - 1], grid_r[k]
+    r = lo + (hi - lo) * (target - grid_ratio[k - 1]) / (grid_ratio[k] - grid_ratio[k - 1])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iter):
+            f = _kosara_equation(r, d, target, radius_val, special_value)
+            lo = np.where(f < 0, r, lo)
+            hi = np.where(f > 0, r, hi)
+
+            angle1 = np.arccos((r**2 + d**2 - radius_val**2) / (2 * r * d))
+            newton = r - f / (2 * r * angle1)
+            inside = np.isfinite(newton) & (newton >= lo) & (newton <= hi)
+            r_next = np.where(inside, newton, (lo + hi) / 2)
+            r_next = np.where(f == 0, r, r_next)
+
+            converged = np.max(np.abs(r_next - r), initial=0) <= tol
+            r = r_next
+            if converged:
+                break
+
+    radius = np.where(a == 0, 0.0, np.nan)
+    radius[valid] = r
+    with np.errstate(invalid="ignore", divide="ignore"):
+        angle = np.where(
+            valid,
+            np.degrees(np.arccos((radius**2 + d**2 - radius_val**2) / (2 * radius * d))),
+            radius,
+        )
+    return radius, angle
+
+
+# precomputed ratio -> (radius, angle) lookup table used by get_kosara_data;
+# it is uniform in w = cbrt(a) - cbrt(1 - a), which straightens the
+# a^(1/3)-like behaviour of the glyph near empty and full cells and lets a
+# lookup index the table directly instead of searching it
+KOSARA_LUT_SIZE = 16385
+KOSARA_LUT_RADIUS_TOLERANCE = 1e-6
+KOSARA_LUT_ANGLE_TOLERANCE = 1e-4
+# within this distance of an empty or full cell the lens area itself is lost
+# to rounding, so the error bound is only checked between the two
+KOSARA_LUT_MIN_RATIO = 1e-9
+
+
+def _kosara_lut_coordinate(ratios):
+    return np.cbrt(ratios) - np.cbrt(1 - ratios)
+
+
+# ratios for lut coordinates, by bisection (w is increasing in the ratio)
+def _kosara_lut_ratio(w):
+    lo = np.zeros_like(w)
+    hi = np.ones_like(w)
+    for _ in range(64):
+        mid = 0.5 * (lo + hi)
+        below = _kosara_lut_coordinate(mid) < w
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+    return 0.5 * (lo + hi)
+
+
+def _kosara_lut_interpolate(table, w):
+    n = len(table["radius"])
+    pos = (w + 1) * (0.5 * (n - 1))
+    idx = np.clip(pos.astype(np.int64), 0, n - 2)
+    frac = pos - idx
+
+    radius = table["radius"][idx]
+    radius += frac * (table["radius"][idx + 1] - radius)
+    angle = table["angle"][idx]
+    angle += frac * (table["angle"][idx + 1] - angle)
+    return radius, angle
+
+
+# build the table once per glyph radius, doubling its size until the error
+# against the solver, measured inside every table interval, is within tolerance
+@lru_cache(maxsize=None)
+def _kosara_lookup_table(radius_val=KOSARA_RADIUS, size=KOSARA_LUT_SIZE):
+    d = np.sqrt(2) * radius_val
+
+    while True:
+        radius, angle = solve_kosara_radius(_kosara_lut_ratio(np.linspace(-1, 1, size)), radius_val)
+        radius[[0, -1]] = d - radius_val, d + radius_val
+        angle[[0, -1]] = 0.0
+        table = {"radius": radius, "angle": angle}
+
+        offsets = np.linspace(-1, 1, size)[:-1, None] + np.array([0.25, 0.5, 0.75]) * (2 / (size - 1))
+        checks = _kosara_lut_ratio(offsets.ravel())
+        checks = checks[(checks >= KOSARA_LUT_MIN_RATIO) & (checks <= 1 - KOSARA_LUT_MIN_RATIO)]
+        expected_radius, expected_angle = solve_kosara_radius(checks, radius_val)
+        lut_radius, lut_angle = _kosara_lut_interpolate(table, _kosara_lut_coordinate(checks))
+        table["max_radius_error"] = float(np.max(np.abs(lut_radius - expected_radius)))
+        table["max_angle_error"] = float(np.max(np.abs(lut_angle - expected_angle)))
+
+        if (
+            table["max_radius_error"] <= KOSARA_LUT_RADIUS_TOLERANCE
+            and table["max_angle_error"] <= KOSARA_LUT_ANGLE_TOLERANCE
+        ) or size >= 2**20:
+            return table
+        size = 2 * size - 1
+
+
+# Kosara radius and angle (degrees) for an array of ratios by interpolating the
+# lookup table; zero ratios give 0, invalid ones NaN (as solve_kosara_radius)
+def lookup_kosara_radius(ratios, radius_val=KOSARA_RADIUS):
+    table = _kosara_lookup_table(radius_val)
+    a = np.asarray(ratios, dtype=np.float64)
+    valid = (a > 0) & (a <= 1)
+
+    radius, angle = _kosara_lut_interpolate(table, _kosara_lut_coordinate(np.where(valid, a, 0)))
+    fallback = np.where(a == 0, 0.0, np.nan)
+    return np.where(valid, radius, fallback), np.where(valid, angle, fallback)
+
+
+# kosara column cache budget in bytes (0 = unlimited)
+KOSARA_CACHE_MAX_BYTES = int(os.getenv("KOSARA_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+# solved Kosara columns (ratio, radius, angle) per (sample, gene, cell set), so
+# adding a gene to a selection only computes the new gene; per-cell
+# total_expression is kept per sample. Entries are dropped when the h5ad changes
+class KosaraCache:
+    def __init__(self, max_bytes=KOSARA_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def cell_set_key(cell_idx):
+        return hashlib.sha1(np.ascontiguousarray(cell_idx, dtype=np.int64).tobytes()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["columns"]
+
+    def put(self, key, columns):
+        nbytes = sum(column.nbytes for column in columns.values())
+        for column in columns.values():
+            column.flags.writeable = False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous["nbytes"]
+            self._entries[key] = {"columns": columns, "nbytes": nbytes}
+            self._nbytes += nbytes
+
+            # evict least recently used columns, always keeping the newest one
+            while self.max_bytes and self._nbytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted["nbytes"]
+                self.evictions += 1
+
+    # per-cell total expression of a whole sample, from the sidecar index if built
+    def total_expression(self, sample_id, adata, mtime):
+        with self._lock:
+            cached = self._totals.get(sample_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        index = get_sample_index(sample_id)
+        if index is not None:
+            totals = np.asarray(index["total_expression"])
         else:
-            return a * 10 - 1.5
-
-    def calculate_radius(originaldf, radius_val):
-        originaldf["radius"] = radius_val
-        result_df = originaldf.copy()
-        for index, row in originaldf.iterrows():
-            for col in gene_list:
-                a_value = row[col + "_original_ratio"]
-                if a_value == 0:
-                    cal_radius = 0
-                    angle = 0
-                else:
-                    try:
-                        guess = initial_guess(a_value, d, special_value)
-                        cal_radius = fsolve(
-                            equation,
-                            guess,
-                            args=(d, a_value, radius_val, special_value),
-                        )[0]
-                        angle = np.degrees(
-                            np.arccos(
-                                (cal_radius**2 + d**2 - radius_val**2)
-                                / (2 * cal_radius * d)
-                            )
-                        )
-                    except ValueError as e:
-                        cal_radius = np.nan
-                        angle = np.nan
-                result_df.loc[index, f"{col}_radius"] = cal_radius
-                result_df.loc[index, f"{col}_angle"] = angle
-
-        return result_df
-
-    def filter_and_merge(cell_ids, gene_names, sample_ids):
-        results = {}
-        for sample_id in sample_ids:
-            if sample_id not in SAMPLES:
-                raise ValueError("Sample not found.")
+            totals = _row_sums(adata, np.arange(adata.n_obs))
+
+        with self._lock:
+            self._totals[sample_id] = (mtime, totals)
+        return totals
+
+    def clear(self, sample_id=None):
+        with self._lock:
+            for key in list(self._entries):
+                if sample_id is None or key[0] == sample_id:
+                    self._nbytes -= self._entries.pop(key)["nbytes"]
+            if sample_id is None:
+                self._totals.clear()
             else:
-                adata_path = SAMPLES[sample_id]["adata"]
-                adata = sc.read_h5ad(adata_path)
-
-                if not cell_ids:
-                    valid_cell_ids = adata.obs_names.tolist()
-                else:
-                    valid_cell_ids = [
-                        cell for cell in cell_ids if cell in adata.obs_names
-                    ]
-
-                valid_gene_names = [
-                    gene for gene in gene_names if gene in adata.var_names
-                ]
-
-                if valid_gene_names:
-                    filtered_adata = adata[valid_cell_ids, valid_gene_names].copy()
-                    if issparse(filtered_adata.X):
-                        expr_data = filtered_adata.X.toarray()
-                    else:
-                        expr_data = filtered_adata.X
-                    expr_df = pd.DataFrame(
-                        expr_data,
-                        index=filtered_adata.obs_names,
-                        columns=filtered_adata.var_names,
-                    )
-                else:
-                    expr_df = pd.DataFrame(index=valid_cell_ids)
-
-                expr_df = expr_df.reset_index().rename(columns={"index": "id"})
+                self._totals.pop(sample_id, None)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+                "samples_with_totals": sorted(self._totals),
+            }
 
-                missing_genes = [
-                    gene for gene in gene_names if gene not in expr_df.columns
-                ]
-                for gene in missing_genes:
-                    expr_df[gene] = 0
 
-                expr_df = expr_df[["id"] + gene_names]
+kosara_cache = KosaraCache()
 
-                coord_df = get_coordinates(sample_id).reset_index(drop=True)
 
-                merged_df = pd.merge(expr_df, coord_df, on="id", how="inner")
+def get_kosara_cache_stats():
+    return kosara_cache.stats()
 
-                merged_df["total_expression"] = adata[valid_cell_ids, :].X.sum(axis=1)
 
-                for gene in gene_names:
-                    merged_df[f"{gene}_original_ratio"] = np.where(
-                        merged_df["total_expression"] == 0,
-                        0,
-                        merged_df[gene] / merged_df["total_expression"],
-                    )
+# ratio / radius / angle columns of the given genes for the cells in cell_idx,
+# computing (and caching) only the genes not cached yet for this cell set
+def _kosara_columns(sample_id, adata, cell_idx, gene_list):
+    mtime = os.path.getmtime(SAMPLES[sample_id]["adata"])
+    cell_key = KosaraCache.cell_set_key(cell_idx)
+    total_expression = kosara_cache.total_expression(sample_id, adata, mtime)[cell_idx]
 
-                results[sample_id] = merged_df
+    columns = {}
+    for gene in gene_list:
+        cached = kosara_cache.get((sample_id, mtime, cell_key, gene))
+        if cached is not None:
+            columns[gene] = cached
 
-        return results
+    missing = [gene for gene in dict.fromkeys(gene_list) if gene not in columns]
+    if missing:
+        gene_idx = adata.var_names.get_indexer(missing)
+        expression = np.zeros((len(cell_idx), len(missing)))
+        found = np.flatnonzero(gene_idx >= 0)
+        if len(found):
+            expression[:, found] = _read_expression(adata, cell_idx, gene_idx[found])
 
-    def get_coordinates(sample_id):
-        if sample_id in SAMPLES:
-            adata = sc.read_h5ad(SAMPLES[sample_id]["adata"])
-            df = adata.obsm["spatial"].copy()
-            df["cell_type"] = adata.obs["cell_type"]
-            df["id"] = adata.obs.index
-            return df
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = np.where(
+                total_expression[:, None] == 0, 0, expression / total_expression[:, None]
+            )
+        radius, angle = lookup_kosara_radius(ratios, KOSARA_RADIUS)
+
+        # each gene owns contiguous copies, so evicting it frees its memory
+        # even while genes solved alongside it stay cached
+        for i, gene in enumerate(missing):
+            columns[gene] = {
+                "ratios": np.ascontiguousarray(ratios[:, i]),
+                "radius": np.ascontiguousarray(radius[:, i]),
+                "angles": np.ascontiguousarray(angle[:, i]),
+            }
+            kosara_cache.put((sample_id, mtime, cell_key, gene), columns[gene])
+
+    return total_expression, columns
+
+
+# cells of a kosara request: a region selection, a cell list, or (for an empty
+# cell list, unless empty_is_all is False) the whole sample
+def _kosara_cell_indices(sample_id, adata, cell_list, selection, empty_is_all=True):
+    if selection is not None:
+        return select_cell_indices(sample_id, selection)
+    if not cell_list:
+        return np.arange(adata.n_obs) if empty_is_all else np.empty(0, dtype=np.int64)
+    cell_idx = adata.obs_names.get_indexer(cell_list)
+    return cell_idx[cell_idx >= 0]
+
+
+# kosara output for the rows of the solved cell set (positions into cell_idx),
+# either one dict per cell or column arrays; cell_table is the sample's
+# _cell_table, fetched once per request
+def _format_kosara(cell_table, cell_idx, rows, total_expression, columns, gene_list, columnar):
+    spatial, codes, categories, ids = cell_table
+    cells = cell_idx[rows]
+    spatial = spatial[cells]
+    codes = np.asarray(codes)[cells]
+    ids = np.asarray(ids)[cells]
+    total_expression = total_expression[rows]
+
+    if columnar:
+        result = {
+            "id": ids.astype(str),
+            "cell_x": spatial[:, 0].astype(np.float32),
+            "cell_y": spatial[:, 1].astype(np.float32),
+            "cell_type": codes.astype(np.int32),
+            "cell_type_categories": categories,
+            "total_expression": total_expression.astype(np.float32),
+        }
+        for gene in gene_list:
+            result[f"{gene}_angle"] = columns[gene]["angles"][rows].astype(np.float32)
+            result[f"{gene}_radius"] = columns[gene]["radius"][rows].astype(np.float32)
+            result[f"{gene}_ratio"] = columns[gene]["ratios"][rows].astype(np.float32)
+        return result
 
-    position_cell_ratios_dict = filter_and_merge(cell_list, gene_list, sample_ids)
+    values = {
+        gene: {key: column[rows].tolist() for key, column in gene_columns.items()}
+        for gene, gene_columns in columns.items()
+    }
+    cell_types = [categories[code] if code >= 0 else None for code in codes.tolist()]
+    formatted_results = []
+    for i, (cell_id, cell_x, cell_y, cell_type, total) in enumerate(zip(
+        ids.tolist(),
+        spatial[:, 0].tolist(),
+        spatial[:, 1].tolist(),
+        cell_types,
+        total_expression.tolist(),
+    )):
+        formatted_results.append({
+            "id": cell_id,
+            "cell_x": cell_x,
+            "cell_y": cell_y,
+            "cell_type": cell_type,
+            "total_expression": total,
+            "angles": {gene: values[gene]["angles"][i] for gene in gene_list},
+            "radius": {gene: values[gene]["radius"][i] for gene in gene_list},
+            "ratios": {gene: values[gene]["ratios"][i] for gene in gene_list},
+        })
+    return formatted_results
+
+
+# get kosara data; columnar=True returns per-sample column arrays (float32
+# <gene>_angle / <gene>_radius / <gene>_ratio plus shared cell columns) instead
+# of one dict per cell.
+# regions is an optional list of named regions ({"name", "cell_list" or
+# "selection", optional "sample_id"}); their cells are solved together in one
+# pass per sample and the results are keyed by region name within each sample
+# (columnar results get a dictionary-coded "region" column instead)
+def get_kosara_data(sample_ids, gene_list, cell_list, selection=None, columnar=False, regions=None):
     results = {}
 
-    for sample_id, merged_df in position_cell_ratios_dict.items():
-        kosara_df = calculate_radius(merged_df, radius)
-        formatted_results = []
-        for _, row in kosara_df.iterrows():
-            transformed_entry = {
-                "id": row["id"],
-                "cell_x": row["cell_x"],
-                "cell_y": row["cell_y"],
-                "cell_type": row["cell_type"],
-                "total_expression": row["total_expression"],
-                "angles": {},
-                "radius": {},
-                "ratios": {},
-            }
+    for sample_id in sample_ids:
+        if sample_id not in SAMPLES:
+            raise ValueError("Sample not found.")
 
-            for gene in gene_list:
-                transformed_entry["angles"][gene] = row.get(f"{gene}_angle", 0)
-                transformed_entry["radius"][gene] = row.get(f"{gene}_radius", 0)
-                transformed_entry["ratios"][gene] = row.get(f"{gene}_original_ratio", 0)
+        adata = sample_registry.get(sample_id)
+        cell_table = _cell_table(sample_id)
 
-            formatted_results.append(transformed_entry)
+        if regions is None:
+            cell_idx = _kosara_cell_indices(sample_id, adata, cell_list, selection)
+            total_expression, columns = _kosara_columns(sample_id, adata, cell_idx, gene_list)
+            results[sample_id] = _format_kosara(
+                cell_table, cell_idx, slice(None), total_expression, columns, gene_list, columnar
+            )
+            continue
 
-        results[sample_id] = formatted_results
+        region_idx = {
+            region["name"]: _kosara_cell_indices(
+                sample_id, adata, region.get("cell_list"), region.get("selection"), empty_is_all=False
+            )
+            for region in regions
+            if region.get("sample_id", sample_id) == sample_id
+        }
+        cell_idx = np.unique(np.concatenate([np.empty(0, dtype=np.int64), *region_idx.values()]))
+        total_expression, columns = _kosara_columns(sample_id, adata, cell_idx, gene_list)
+        region_rows = {name: np.searchsorted(cell_idx, idx) for name, idx in region_idx.items()}
+
+        if columnar:
+            rows = np.concatenate([np.empty(0, dtype=np.int64), *region_rows.values()])
+            result = _format_kosara(cell_table, cell_idx, rows, total_expression, columns, gene_list, True)
+            result["region"] = np.repeat(
+                np.arange(len(region_rows), dtype=np.int32), [len(r) for r in region_rows.values()]
+            )
+            result["region_categories"] = list(region_rows)
+            results[sample_id] = result
+        else:
+            results[sample_id] = {
+                name: _format_kosara(cell_table, cell_idx, rows, total_expression, columns, gene_list, False)
+                for name, rows in region_rows.items()
+            }
 
     return results
 
 
-# get selected region's gene expression data
-def get_selected_region_data(sample_id, cell_ids):
-    if sample_id not in SAMPLES:
-        raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
-    
-    adata_path = SAMPLES[sample_id]["adata"]
-    adata = sc.read_h5ad(adata_path)
+def _region_rows(adata, sample_id, cell_ids, selection):
+    if selection is not None:
+        return select_cell_indices(sample_id, selection)
+    return np.flatnonzero(adata.obs.index.isin(cell_ids))
 
-    # filter cells based on cell_ids
-    selected_cells_mask = adata.obs.index.isin(cell_ids)
-    filtered_adata = adata[selected_cells_mask]
-    
-    all_genes = set()
-    cell_expressions = {}
 
-    for i, cell in enumerate(filtered_adata.obs.index):
-        expression_values = filtered_adata[i].X.A[0] if hasattr(filtered_adata[i].X, 'A') else filtered_adata[i].X[0]
-        nonzero_indices = np.where(expression_values > 0)[0]
-        cell_expression = {filtered_adata.var.index[j]: float(expression_values[j]) for j in nonzero_indices}
+# CSR expression of the given cells over the genes expressed (> 0) in at least
+# one of them, sorted by gene name; non-positive values are dropped
+def _region_matrix(adata, rows):
+    X = adata.X[rows]
+    X = X.tocsr() if issparse(X) else csr_matrix(X)
+    X.data[X.data <= 0] = 0
+    X.eliminate_zeros()
 
-        cell_expressions[cell] = cell_expression
-        all_genes.update(cell_expression.keys())
+    gene_idx = np.unique(X.indices)
+    gene_names = adata.var_names[gene_idx]
+    order = np.argsort(gene_names.to_numpy(dtype=str), kind="stable")
+    return X[:, gene_idx[order]], gene_names[order].tolist()
 
-    all_genes = sorted(all_genes)
 
-    expression_data = [
-        {
-            "cell_id": cell,
-            "expression": [cell_expressions[cell].get(gene, 0.0) for gene in all_genes]
-        }
-        for cell in filtered_adata.obs.index
-    ]
+# get selected region's gene expression data; format="csr" returns the
+# expression as a CSR triplet over the expressed genes instead of dense rows
+def get_selected_region_data(sample_id, cell_ids, selection=None, format="dense"):
+    if sample_id not in SAMPLES:
+        raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
+    
+    adata = sample_registry.get(sample_id)
 
-    cell_type_annotations = filtered_adata.obs["cell_type"].to_dict()
+    # filter cells based on cell_ids, or on a region selection resolved server-side
+    rows = _region_rows(adata, sample_id, cell_ids, selection)
 
-    return {
+    X, all_genes = _region_matrix(adata, rows)
+    cell_names = adata.obs_names[rows]
+    cell_type_annotations = dict(zip(cell_names, adata.obs["cell_type"].iloc[rows]))
+
+    result = {
         "metadata": {
-            "cell_ids": list(filtered_adata.obs.index),
+            "cell_ids": list(cell_names),
             "genes": all_genes,
             "cell_type_annotations": cell_type_annotations,
         },
-        "expression_data": expression_data,
     }
 
+    if format == "csr":
+        X.sort_indices()
+        result["expression_csr"] = {
+            "data": X.data.tolist(),
+            "indices": X.indices.tolist(),
+            "indptr": X.indptr.tolist(),
+            "shape": list(X.shape),
+        }
+    else:
+        result["expression_data"] = [
+            {"cell_id": cell, "expression": expression}
+            for cell, expression in zip(cell_names, X.toarray().tolist())
+        ]
+
+    return result
+
+
+# stream the selected region's gene expression: a header with the gene list,
+# then chunks of at most chunk_size cells, densified one chunk at a time. The
+# sample and selection are resolved before the generator is returned, so bad
+# requests raise here rather than in the middle of a streamed response
+def iter_selected_region_data(sample_id, cell_ids, selection=None, chunk_size=1000):
+    if sample_id not in SAMPLES:
+        raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
+
+    adata = sample_registry.get(sample_id)
+    rows = _region_rows(adata, sample_id, cell_ids, selection)
+    X, all_genes = _region_matrix(adata, rows)
+    cell_names = adata.obs_names[rows]
+    cell_types = adata.obs["cell_type"].iloc[rows]
+
+    def chunks():
+        yield {"metadata": {"genes": all_genes, "n_cells": len(rows)}}
+
+        for start in range(0, len(rows), chunk_size):
+            end = start + chunk_size
+            yield {
+                "cell_type_annotations": dict(zip(cell_names[start:end], cell_types[start:end])),
+                "expression_data": [
+                    {"cell_id": cell, "expression": expression}
+                    for cell, expression in zip(cell_names[start:end], X[start:end].toarray().tolist())
+                ],
+            }
+
+    return chunks()
+
+
+GO_GENE_SETS = "../Data/c5.go.v2024.1.Hs.symbols.gmt"
+
+
+# whether gene names are mostly (>= 90%) upper case symbols, as gseapy checks
+def _mostly_upper(genes):
+    genes = [str(gene) for gene in genes]
+    if not genes or all(gene.isdigit() for gene in genes):
+        return False
+    return sum(gene.isupper() for gene in genes) / len(genes) >= 0.9
+
+
+# a GMT file held as a sparse gene x term incidence matrix; enrich() scores
+# several gene lists against every term at once with the same hypergeometric
+# test, odds ratio, combined score and BH correction as gseapy.enrich (whose
+# default background is all genes in the GMT)
+class GeneSetIndex:
+    COLUMNS = ["Gene_set", "Term", "Overlap", "P-value", "Adjusted P-value",
+               "Odds Ratio", "Combined Score", "Genes"]
+
+    def __init__(self, path):
+        gene_sets = {}
+        with open(path) as gmt:
+            for line in gmt:
+                parts = line.strip().split("\t")
+                if len(parts) > 2:
+                    gene_sets[parts[0]] = parts[2:]
+
+        self.name = os.path.basename(path)
+        self.upper = all(_mostly_upper(genes) for genes in list(gene_sets.values())[:10])
+        self.terms = np.array(sorted(gene_sets), dtype=object)
+
+        gene_index = {}
+        rows, cols = [], []
+        for col, term in enumerate(self.terms):
+            for gene in set(gene_sets[term]):
+                rows.append(gene_index.setdefault(gene, len(gene_index)))
+                cols.append(col)
+        self.gene_index = gene_index
+        self.genes = np.array(list(gene_index), dtype=object)
+        self.incidence = csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=(len(gene_index), len(self.terms)),
+        )
+        self.term_sizes = np.asarray(self.incidence.sum(axis=0)).ravel()
+
+    def enrich(self, gene_lists):
+        n_background = len(self.gene_index)
+
+        # query genes outside the background are dropped, as in gseapy
+        queries = []
+        for genes in gene_lists:
+            genes = [str(gene).strip() for gene in genes]
+            if self.upper and not _mostly_upper(genes):
+                genes = [gene.upper() for gene in genes]
+            queries.append(sorted({self.gene_index[g] for g in genes if g in self.gene_index}))
+
+        membership = csr_matrix(
+            (
+                np.ones(sum(len(q) for q in queries), dtype=np.int32),
+                np.concatenate([np.asarray(q, dtype=np.int64) for q in queries] + [np.empty(0, dtype=np.int64)]),
+                np.concatenate([[0], np.cumsum([len(q) for q in queries])]),
+            ),
+            shape=(len(queries), n_background),
+        )
+        overlaps = (membership @ self.incidence).tocoo()
+
+        # one hypergeometric test over every (gene list, term) pair with a hit
+        x = overlaps.data.astype(np.float64)
+        m = self.term_sizes[overlaps.col].astype(np.float64)
+        k = np.array([len(q) for q in queries], dtype=np.float64)[overlaps.row]
+        p_values = hypergeom.sf(x - 1, n_background, m, k)
+        odds_ratios = ((x + 0.5) * (n_background - m - k + x + 0.5)) / ((m - x + 0.5) * (k - x + 0.5))
+
+        results = []
+        for i, query in enumerate(queries):
+            pairs = np.flatnonzero(overlaps.row == i)
+            pairs = pairs[np.argsort(overlaps.col[pairs], kind="stable")]
+            terms = overlaps.col[pairs]
+            hits = self.incidence[query][:, terms].tocsc()
+            results.append(pd.DataFrame({
+                "Gene_set": self.name,
+                "Term": self.terms[terms],
+                "Overlap": [f"{a}/{b}" for a, b in zip(overlaps.data[pairs], self.term_sizes[terms])],
+                "P-value": p_values[pairs],
+                "Adjusted P-value": _benjamini_hochberg(p_values[pairs]),
+                "Odds Ratio": odds_ratios[pairs],
+                "Combined Score": -np.log(p_values[pairs]) * odds_ratios[pairs],
+                "Genes": [
+                    ";".join(self.genes[np.asarray(query)[hits.indices[hits.indptr[j]:hits.indptr[j + 1]]]])
+                    for j in range(len(terms))
+                ],
+            }, columns=self.COLUMNS))
+        return results
+
+
+def _benjamini_hochberg(p_values):
+    n = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = p_values[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1)
+    result = np.empty(n)
+    result[order] = adjusted
+    return result
+
+
+_gene_set_indexes = {}
+_gene_set_indexes_lock = threading.Lock()
+
+
+# gene set index of a GMT file, parsed once and reparsed when the file changes
+def get_gene_set_index(path):
+    mtime = os.path.getmtime(path)
+    with _gene_set_indexes_lock:
+        cached = _gene_set_indexes.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, GeneSetIndex(path))
+            _gene_set_indexes[path] = cached
+    return cached[1]
+
+
+# worker processes used for NMF rank selection (joblib n_jobs, -1 = all cores)
+NMF_N_JOBS = int(os.getenv("NMF_N_JOBS", "-1"))
+
+
+# compute cophenetic correlation method
+def compute_cophenetic(W):
+    try:
+        dist = pdist(W.T)
+        linkage_matrix = linkage(dist, method='average')
+        coph_corr, _ = cophenet(linkage_matrix, dist)
+        return coph_corr
+    except Exception:
+        return np.nan
+
+
+# regions with more cells than this are factorized with MiniBatchNMF (0 = never)
+NMF_MINIBATCH_CELLS = int(os.getenv("NMF_MINIBATCH_CELLS", "50000"))
+
+
+def _make_nmf(n_components, n_cells, random_state, **kwargs):
+    if NMF_MINIBATCH_CELLS and n_cells > NMF_MINIBATCH_CELLS:
+        return MiniBatchNMF(n_components=n_components, init='nndsvda', random_state=random_state, **kwargs)
+    return NMF(n_components=n_components, init='nndsvda', random_state=random_state, **kwargs)
+
+
+# Frobenius norm of X - W @ H without forming W @ H (X dense or sparse):
+# |X|^2 - 2 <X H^T, W> + <W^T W, H H^T>
+def _nmf_reconstruction_error(X, W, H):
+    norm_x = X.multiply(X).sum() if issparse(X) else np.sum(X * X)
+    cross = np.sum(np.asarray(X @ H.T) * W)
+    gram = np.sum((W.T @ W) * (H @ H.T))
+    return np.sqrt(max(norm_x - 2 * cross + gram, 0.0))
+
+
+# one NMF fit of rank-selection: (cophenetic, reconstruction error, seconds)
+def _fit_nmf_rank(expr_matrix, k, random_state):
+    start = time.perf_counter()
+    nmf = _make_nmf(k, expr_matrix.shape[0], random_state, max_iter=1000)
+    W = nmf.fit_transform(expr_matrix)
+    H = nmf.components_
+    error = _nmf_reconstruction_error(expr_matrix, W, H)
+    coph = compute_cophenetic(W)
+    return coph, error, time.perf_counter() - start
+
+
+# finding the best k for NMF: the smallest k whose mean cophenetic reaches
+# coph_threshold, else the k with the highest one. Ranks are fitted in order,
+# n_jobs ranks (x n_repeats fits) at a time across a process pool, and the
+# sweep stops after the first batch in which a rank reaches the threshold.
+# results are (k, mean cophenetic, mean error, seconds spent fitting k)
+def auto_select_nmf_k_from_expr(expr_matrix, k_range=range(2, 21), n_repeats=5, random_state=42,
+                                coph_threshold=0.98, n_jobs=NMF_N_JOBS):
+    k_range = list(k_range)
+    n_workers = max(1, min(effective_n_jobs(n_jobs), len(k_range) * n_repeats))
+    batch_size = max(1, -(-n_workers // n_repeats))
+    results = []
+
+    report_progress("rank selection", 0, len(k_range))
+    with Parallel(n_jobs=n_workers) as parallel:
+        for start in range(0, len(k_range), batch_size):
+            batch = k_range[start:start + batch_size]
+            fits = parallel(
+                delayed(_fit_nmf_rank)(expr_matrix, k, random_state + i)
+                for k in batch
+                for i in range(n_repeats)
+            )
+
+            for j, k in enumerate(batch):
+                cophs, errors, times = zip(*fits[j * n_repeats:(j + 1) * n_repeats])
+                results.append((k, np.nanmean(cophs), np.mean(errors), float(np.sum(times))))
+            report_progress("rank selection", len(results), len(k_range))
+
+            # ranks are fitted in increasing order, so the first batch with a
+            # rank over the threshold holds the smallest such k
+            if any(coph >= coph_threshold for _, coph, _, _ in results):
+                break
+
+    # filtered cophenetic equals to nan
+    valid_results = [(k, coph) for k, coph, _, _ in results if not np.isnan(coph)]
+
+    # choose the min k with the first cophenetic >= 0.97
+    for k, coph in valid_results:
+        if coph >= coph_threshold:
+            return k, results
+
+    best_k = max(valid_results, key=lambda x: x[1])[0]
+    return best_k, results
+
+
+# disk-backed store of get_NMF_GO_data results (0 = unlimited size)
+NMF_CACHE_DIR = os.getenv("NMF_CACHE_DIR", "../Data/nmf_cache")
+NMF_CACHE_MAX_BYTES = int(os.getenv("NMF_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# bump when a change to the NMF / clustering / GO code changes its results
+NMF_GO_CACHE_VERSION = 1
+
+_sample_checksums = {}
+
+
+# sha256 of a sample's h5ad, taken from its sidecar index when available and
+# otherwise computed once per file version
+def _sample_checksum(sample_id):
+    index = get_sample_index(sample_id)
+    if index is not None and index.get("sha256"):
+        return index["sha256"]
+
+    path = SAMPLES[sample_id]["adata"]
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _sample_checksums:
+        _sample_checksums[key] = _file_checksum(path)
+    return _sample_checksums[key]
+
+
+# result key of an NMF / GO request: sample contents, the (order independent)
+# cell set, the parameters, the GO gene sets and the code version
+def _nmf_go_cache_key(sample_id, cell_ids, params):
+    gene_sets = os.stat(GO_GENE_SETS) if os.path.exists(GO_GENE_SETS) else None
+    fingerprint = {
+        "sample": _sample_checksum(sample_id),
+        "cells": hashlib.sha256("\n".join(sorted(map(str, cell_ids))).encode()).hexdigest(),
+        "params": params,
+        "gene_sets": [GO_GENE_SETS, gene_sets.st_size, gene_sets.st_mtime] if gene_sets else None,
+        "version": NMF_GO_CACHE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+# one pickle per result, named <sample_id>-<key>.pkl; the least recently used
+# results are deleted when the directory grows over max_bytes
+class NMFResultCache:
+    def __init__(self, cache_dir=NMF_CACHE_DIR, max_bytes=NMF_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, sample_id, key):
+        return os.path.join(self.cache_dir, f"{sample_id}-{key}.pkl")
+
+    def _files(self):
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        paths = [os.path.join(self.cache_dir, name) for name in names if name.endswith(".pkl")]
+        return [(path, os.stat(path)) for path in paths if os.path.isfile(path)]
+
+    # the stored result, with its rows put back in the order of cell_ids
+    def get(self, sample_id, key, cell_ids):
+        path = self._path(sample_id, key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        result = entry["result"]
+        stored_ids = pd.Index(entry["cell_ids"])
+        if not stored_ids.equals(pd.Index(cell_ids)):
+            rows = stored_ids.get_indexer(cell_ids)
+            rank = pd.Series(np.arange(len(cell_ids)), index=cell_ids)
+            result = dict(result)
+            result["NMF_matrix"] = [result["NMF_matrix"][row] for row in rows]
+            result["cell_ids_by_cluster"] = {
+                cluster: sorted(ids, key=rank.get)
+                for cluster, ids in result["cell_ids_by_cluster"].items()
+            }
+        return result
+
+    def put(self, sample_id, key, cell_ids, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(sample_id, key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump({"cell_ids": list(cell_ids), "result": result}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error storing NMF result: {str(e)}")
+            return
+        self._enforce_budget(keep=path)
+
+    def _enforce_budget(self, keep):
+        if not self.max_bytes:
+            return
+
+        with self._lock:
+            files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+            total = sum(stat.st_size for _, stat in files)
+            for path, stat in files:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= stat.st_size
+                self.evictions += 1
+
+    # delete the stored results of one sample, or of all samples; returns how many
+    def invalidate(self, sample_id=None):
+        removed = 0
+        with self._lock:
+            for path, _ in self._files():
+                if sample_id is not None and not os.path.basename(path).startswith(f"{sample_id}-"):
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def stats(self):
+        files = self._files()
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "entries": len(files),
+                "bytes": sum(stat.st_size for _, stat in files),
+                "max_bytes": self.max_bytes,
+                "cache_dir": self.cache_dir,
+            }
+
+
+nmf_go_cache = NMFResultCache()
+
+
+def invalidate_nmf_go_cache(sample_id=None):
+    return nmf_go_cache.invalidate(sample_id)
+
+
+def get_nmf_go_cache_stats():
+    return nmf_go_cache.stats()
+
+
+# optional gene prefiltering in front of NMF: keep genes detected in at least
+# NMF_MIN_DETECTION_RATE of the selected cells, then the NMF_TOP_GENES most
+# variable of them (0 = keep all)
+NMF_TOP_GENES = int(os.getenv("NMF_TOP_GENES", "0"))
+NMF_MIN_DETECTION_RATE = float(os.getenv("NMF_MIN_DETECTION_RATE", "0"))
+
+
+# column indices of the genes kept for NMF, ranked by dispersion (variance /
+# mean) among the genes passing the detection rate; returned in column order
+def _select_nmf_genes(X, n_top_genes=NMF_TOP_GENES, min_detection_rate=NMF_MIN_DETECTION_RATE):
+    n_cells, n_genes = X.shape
+    if n_cells == 0 or (not n_top_genes and not min_detection_rate):
+        return np.arange(n_genes)
+
+    if issparse(X):
+        detected = np.bincount(X.indices[X.data > 0], minlength=n_genes)
+        mean = np.asarray(X.mean(axis=0)).ravel()
+        mean_sq = np.asarray(X.multiply(X).mean(axis=0)).ravel()
+    else:
+        detected = np.count_nonzero(X > 0, axis=0)
+        mean = X.mean(axis=0)
+        mean_sq = (X * X).mean(axis=0)
+
+    candidates = np.flatnonzero((detected > 0) & (detected / n_cells >= min_detection_rate))
+    if n_top_genes and len(candidates) > n_top_genes:
+        dispersion = (mean_sq - mean**2)[candidates] / mean[candidates]
+        candidates = candidates[np.argsort(-dispersion, kind="stable")[:n_top_genes]]
+    return np.sort(candidates)
+
+
+# silhouette scores of selections larger than this are computed on a random
+# sample of this many cells (0 = always exact)
+NMF_SILHOUETTE_SAMPLE = int(os.getenv("NMF_SILHOUETTE_SAMPLE", "10000"))
+
+
+# umap connectivities (as sc.pp.neighbors) from the first n_neighbors columns
+# of a kNN query that includes each cell itself
+def _knn_connectivities(knn_indices, knn_dists, n_neighbors):
+    connectivities, _, _ = fuzzy_simplicial_set(
+        coo_matrix((len(knn_indices), 1)),
+        n_neighbors,
+        None,
+        None,
+        knn_indices=knn_indices[:, :n_neighbors],
+        knn_dists=knn_dists[:, :n_neighbors],
+    )
+    return connectivities.tocsr()
+
+
+# metacells: selections of at least METACELL_MIN_CELLS cells are coarse-grained
+# into groups of about METACELL_SIZE cells that are close both in space and in
+# expression; the expensive analyses run on the group means and their results
+# are projected back onto the cells (METACELL_SIZE 0 = never)
+METACELL_SIZE = int(os.getenv("METACELL_SIZE", "20"))
+METACELL_MIN_CELLS = int(os.getenv("METACELL_MIN_CELLS", "20000"))
+METACELL_SPATIAL_WEIGHT = float(os.getenv("METACELL_SPATIAL_WEIGHT", "1.0"))
+METACELL_SVD_COMPONENTS = 20
+
+
+# embedding the metacells are grouped in: the top SVD components of log
+# expression next to the spatial coordinates, each block scaled to unit total
+# variance and the spatial block weighted by spatial_weight
+def _metacell_features(X, coords, spatial_weight, n_components, random_state):
+    def unit_variance(block):
+        block = block - block.mean(axis=0)
+        scale = np.sqrt((block**2).sum(axis=1).mean())
+        return block / scale if scale > 0 else block
+
+    features = []
+    n_components = min(n_components, X.shape[1] - 1)
+    if n_components > 0:
+        log_expr = X.log1p() if issparse(X) else np.log1p(X)
+        svd = TruncatedSVD(n_components=n_components, random_state=random_state)
+        features.append(unit_variance(svd.fit_transform(log_expr)))
+    if spatial_weight:
+        features.append(spatial_weight * unit_variance(np.asarray(coords, dtype=np.float64)))
+    return np.hstack(features).astype(np.float32)
+
+
+# metacell label (0..n_metacells-1) of every row of X: MiniBatchKMeans into about
+# sqrt(n_metacells) coarse groups, then KMeans inside each group down to about
+# target_size cells per metacell, far cheaper than one KMeans with thousands of
+# centers
+def compute_metacells(X, coords, target_size=METACELL_SIZE, spatial_weight=METACELL_SPATIAL_WEIGHT,
+                      n_components=METACELL_SVD_COMPONENTS, random_state=0):
+    n_cells = X.shape[0]
+    n_metacells = max(1, int(round(n_cells / target_size)))
+    if n_metacells >= n_cells:
+        return np.arange(n_cells)
+
+    features = _metacell_features(X, coords, spatial_weight, n_components, random_state)
+    n_groups = int(np.ceil(np.sqrt(n_metacells)))
+    groups = MiniBatchKMeans(n_clusters=n_groups, batch_size=4096, n_init=3,
+                             random_state=random_state).fit_predict(features)
+
+    labels = np.empty(n_cells, dtype=np.int64)
+    offset = 0
+    for group in range(n_groups):
+        members = np.flatnonzero(groups == group)
+        k = min(len(members), max(1, int(round(len(members) / target_size))))
+        if k <= 1:
+            labels[members] = offset
+        else:
+            labels[members] = offset + KMeans(n_clusters=k, n_init=1, random_state=random_state).fit_predict(features[members])
+        offset += max(k, 1)
+
+    # drop labels left empty by the partition
+    return np.unique(labels, return_inverse=True)[1]
+
+
+# metacell-by-cell matrix averaging the members of each metacell
+def metacell_indicator(labels, dtype=np.float64):
+    labels = np.asarray(labels)
+    counts = np.bincount(labels)
+    return csr_matrix(
+        ((1.0 / counts[labels]).astype(dtype), (labels, np.arange(len(labels)))),
+        shape=(len(counts), len(labels)),
+    )
+
+
+# mean expression of each metacell, in a floating dtype at least as wide as
+# X's (float32 stays float32); sparse input stays sparse
+def aggregate_metacells(X, labels):
+    return metacell_indicator(labels, dtype=np.result_type(X.dtype, np.float32)) @ X
 
-def get_NMF_GO_data(sample_id, cell_list):
-    # finding the best n_neighbors for leiden clustering
+
+def get_NMF_GO_data(sample_id, cell_list, selection=None, n_top_genes=NMF_TOP_GENES,
+                    min_detection_rate=NMF_MIN_DETECTION_RATE, metacell_size=METACELL_SIZE):
+    # finding the best n_neighbors for leiden clustering; the candidates share
+    # one kNN query at the largest n_neighbors, and their graphs are returned so
+    # the final clustering can reuse the winner's
     def compute_silhouette_scores(adata, n_neighbors_list=[5, 10, 15, 20, 30]):
         silhouette_scores = {}
+        graphs = {}
+
+        X_nmf = adata.obsm['X_nmf']
+        max_neighbors = min(max(n_neighbors_list), adata.n_obs)
+        knn_dists, knn_indices = cKDTree(X_nmf).query(X_nmf, k=max_neighbors)
+
+        # silhouette of large selections is estimated on a sample of cells
+        sample_size = None
+        if NMF_SILHOUETTE_SAMPLE and adata.n_obs > NMF_SILHOUETTE_SAMPLE:
+            sample_size = NMF_SILHOUETTE_SAMPLE
 
-        for n_neighbors in n_neighbors_list:
+        for i, n_neighbors in enumerate(n_neighbors_list):
+            report_progress("clustering", i, len(n_neighbors_list))
             print(f"Trying n_neighbors = {n_neighbors}")
-            # calculate neighbors
-            sc.pp.neighbors(adata, use_rep='X_nmf', n_neighbors=n_neighbors)
+            # neighbors graph from the first n_neighbors of the shared query
+            graphs[n_neighbors] = _knn_connectivities(knn_indices, knn_dists, min(n_neighbors, max_neighbors))
 
             # leiden clustering
-            sc.tl.leiden(adata, resolution=0.5)
+            sc.tl.leiden(adata, resolution=0.5, adjacency=graphs[n_neighbors])
             
             # calculate silhouette score
             labels = adata.obs['leiden'].astype(int)
-            silhouette_avg = silhouette_score(adata.obsm['X_nmf'], labels)
+            silhouette_avg = silhouette_score(X_nmf, labels, sample_size=sample_size, random_state=0)
 
             silhouette_scores[n_neighbors] = silhouette_avg
             print(f"Silhouette score for n_neighbors={n_neighbors}: {silhouette_avg:.3f}")
         
-        return silhouette_scores
-
-    # compute cophenetic correlation method
-    def compute_cophenetic(W):
-        try:
-            dist = pdist(W.T)
-            linkage_matrix = linkage(dist, method='average')
-            coph_corr, _ = cophenet(linkage_matrix, dist)
-            return coph_corr
-        except Exception:
-            return np.nan
-
-    # finding the best k for NMF
-    def auto_select_nmf_k_from_expr(expr_matrix, k_range=range(2, 21), n_repeats=5, random_state=42, coph_threshold=0.98):
-        results = []
-
-        for k in k_range:
-            cophs = []
-            errors = []
-            for i in range(n_repeats):
-                nmf = NMF(n_components=k, init='nndsvda', random_state=random_state+i, max_iter=1000)
-                W = nmf.fit_transform(expr_matrix)
-                H = nmf.components_
-                recon = np.dot(W, H)
-                error = np.linalg.norm(expr_matrix - recon)
-                coph = compute_cophenetic(W)
-                errors.append(error)
-                cophs.append(coph)
-
-            avg_coph = np.nanmean(cophs)
-            avg_error = np.mean(errors)
-            results.append((k, avg_coph, avg_error))
-
-        # filtered cophenetic equals to nan
-        valid_results = [(k, coph) for k, coph, _ in results if not np.isnan(coph)]
-
-        # choose the min k with the first cophenetic >= 0.97
-        for k, coph in valid_results:
-            if coph >= coph_threshold:
-                return k, results
-
-        best_k = max(valid_results, key=lambda x: x[1])[0]
-        return best_k, results
+        return silhouette_scores, graphs
 
     # get top genes of each component(NMF)
     def get_top_genes(H, gene_names, top_n=10):
@@ -443,29 +1918,82 @@ def get_NMF_GO_data(sample_id, cell_list):
         raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
 
     # ========== Load the data for the specified sample ID ========== 
-    adata_path = SAMPLES[sample_id]["adata"]
-    adata = sc.read_h5ad(adata_path)
-
-    adata_region = adata[cell_list, :].copy()
+    adata = sample_registry.get(sample_id)
+
+    if selection is not None:
+        cell_list = select_cell_indices(sample_id, selection)
+
+    # ========== return a stored result for the same cells and parameters ==========
+    cell_ids = adata[cell_list, :].obs_names
+    cache_key = _nmf_go_cache_key(sample_id, cell_ids, {
+        "n_top_genes": n_top_genes,
+        "min_detection_rate": min_detection_rate,
+        "minibatch_cells": NMF_MINIBATCH_CELLS,
+        "silhouette_sample": NMF_SILHOUETTE_SAMPLE,
+        "metacell_size": metacell_size,
+        "metacell_min_cells": METACELL_MIN_CELLS,
+        "metacell_spatial_weight": METACELL_SPATIAL_WEIGHT,
+    })
+    cached = nmf_go_cache.get(sample_id, cache_key, cell_ids)
+    if cached is not None:
+        return cached
+
+    report_progress("loading")
+    adata_region = _materialize(adata[cell_list, :])
+    # sparse expression stays CSR so memory follows the non-zeros
     expr_matrix = adata_region.X
-    if not isinstance(expr_matrix, np.ndarray):
-        expr_matrix = expr_matrix.toarray()
+    if issparse(expr_matrix):
+        expr_matrix = csr_matrix(expr_matrix)
+        if not np.issubdtype(expr_matrix.dtype, np.floating):
+            expr_matrix = expr_matrix.astype(np.float64)
+    else:
+        expr_matrix = np.asarray(expr_matrix)
+        if not np.issubdtype(expr_matrix.dtype, np.floating):
+            expr_matrix = expr_matrix.astype(np.float64)
+
+    # factorize only the kept genes; gene_idx maps components back to var_names
+    gene_idx = _select_nmf_genes(expr_matrix, n_top_genes, min_detection_rate)
+    if len(gene_idx) < 2:
+        raise ValueError(
+            f"Only {len(gene_idx)} genes pass gene prefiltering (n_top_genes={n_top_genes}, "
+            f"min_detection_rate={min_detection_rate}); NMF needs at least 2."
+        )
+    if len(gene_idx) < expr_matrix.shape[1]:
+        expr_matrix = expr_matrix[:, gene_idx]
+        print(f"NMF on {len(gene_idx)} of {adata.n_vars} genes")
+
+    # ========== coarse-grain large selections into metacells ==========
+    # rank selection, NMF and clustering run on the metacell means (fit_matrix)
+    # and are projected back onto the cells afterwards
+    metacells = None
+    fit_matrix = expr_matrix
+    adata_fit = adata_region
+    n_cells = expr_matrix.shape[0]
+    if metacell_size and n_cells >= max(METACELL_MIN_CELLS, 2 * metacell_size):
+        coords = np.asarray(adata_region.obsm["spatial"], dtype=np.float64)[:, :2]
+        report_progress("metacells")
+        metacells = compute_metacells(expr_matrix, coords, metacell_size)
+        fit_matrix = aggregate_metacells(expr_matrix, metacells)
+        adata_fit = ad.AnnData(obs=pd.DataFrame(index=[f"metacell_{i}" for i in range(fit_matrix.shape[0])]))
+        print(f"NMF on {fit_matrix.shape[0]} metacells of {n_cells} cells")
 
     # ========== find the best component number for NMF ==========
-    best_k, k_results = auto_select_nmf_k_from_expr(expr_matrix)
+    # NMF (nndsvda) needs at most min(cells, genes) components
+    best_k, k_results = auto_select_nmf_k_from_expr(fit_matrix, k_range=range(2, min(21, min(fit_matrix.shape) + 1)))
 
-    for k, coph, err in k_results:
-        print(f"k={k}, Cophenetic={coph:.3f}, Error={err:.2f}")
+    for k, coph, err, elapsed in k_results:
+        print(f"k={k}, Cophenetic={coph:.3f}, Error={err:.2f}, Time={elapsed:.2f}s")
 
     # ========== NMF ==========
+    report_progress("nmf")
     n_components = best_k
-    nmf_model = NMF(n_components=n_components, init='nndsvda', random_state=42)
-    W = nmf_model.fit_transform(expr_matrix)
+    nmf_model = _make_nmf(n_components, fit_matrix.shape[0], 42)
+    W = nmf_model.fit_transform(fit_matrix)
     H = nmf_model.components_ 
 
     # ========== clustering NMF result(M) ==========
-    adata_region.obsm['X_nmf'] = W
-    sil_scores = compute_silhouette_scores(adata_region, n_neighbors_list=[5, 10, 15, 20, 30])
+    adata_fit.obsm['X_nmf'] = W
+    sil_scores, graphs = compute_silhouette_scores(adata_fit, n_neighbors_list=[5, 10, 15, 20, 30])
 
     print("\nSilhouette scores for different n_neighbors:")
     for n, score in sil_scores.items():
@@ -475,8 +2003,15 @@ def get_NMF_GO_data(sample_id, cell_list):
     best_n_neighbors = max(sil_scores, key=sil_scores.get)
     print(f"\nBest n_neighbors based on silhouette score: {best_n_neighbors}")
 
-    sc.pp.neighbors(adata_region, use_rep='X_nmf', n_neighbors=best_n_neighbors)
-    sc.tl.leiden(adata_region, resolution=0.1)
+    report_progress("clustering", len(sil_scores), len(sil_scores))
+    sc.tl.leiden(adata_fit, resolution=0.1, adjacency=graphs[best_n_neighbors])
+
+    # cells take their metacell's cluster and their own loadings on H
+    if metacells is not None:
+        leiden = adata_fit.obs['leiden']
+        adata_region.obs['leiden'] = pd.Categorical.from_codes(
+            leiden.cat.codes.to_numpy()[metacells], categories=leiden.cat.categories)
+        W = nmf_model.transform(expr_matrix)
 
     clusters = adata_region.obs['leiden']
 
@@ -495,21 +2030,17 @@ def get_NMF_GO_data(sample_id, cell_list):
     }
 
     # ========== Go analysis based on the result of NMF(H) ==========
-    gene_names = adata.var_names.tolist()
+    report_progress("go enrichment")
+    gene_names = adata.var_names[gene_idx].tolist()
     top_genes = get_top_genes(H, gene_names, top_n=10)
 
     go_results = {}
 
-    for comp, genes in top_genes.items():
-        print(f"analyzing {comp} ...")
-        enr = gp.enrich(
-            gene_list=genes,
-            gene_sets="../Data/c5.go.v2024.1.Hs.symbols.gmt",
-            outdir=None,
-            cutoff=0.5,
-        )
+    enrichments = get_gene_set_index(GO_GENE_SETS).enrich(list(top_genes.values()))
 
-        filtered = enr.results[enr.results["Adjusted P-value"] < 0.05]
+    for comp, results in zip(top_genes, enrichments):
+        print(f"analyzing {comp} ...")
+        filtered = results[results["Adjusted P-value"] < 0.05]
         filtered = filtered.sort_values(by="Combined Score", ascending=False)
         filtered_top5 = filtered.head(5)
         if not filtered.empty:
@@ -517,61 +2048,331 @@ def get_NMF_GO_data(sample_id, cell_list):
         else:
             print(f"{comp} no GO results found.")
     
-    return {
+    result = {
         "NMF_matrix": W.tolist(),
         "GO_results": go_results,
         "cluster_means": cluster_means.to_dict(orient="records"),
         "cell_ids_by_cluster": cell_ids_by_cluster,
+        "k_selection": [
+            {
+                "k": k,
+                "cophenetic": None if np.isnan(coph) else float(coph),
+                "error": float(err),
+                "time": elapsed,
+            }
+            for k, coph, err, elapsed in k_results
+        ],
     }
+    nmf_go_cache.put(sample_id, cache_key, cell_ids, result)
+    return result
 
 
-def get_cell_cell_interaction_data(sample_id, receiver, sender, receiverGene, senderGene, cellIds):
-    result = {}
-    
+# DEAPLOG runs as a script in its own interpreter; runs longer than this are killed
+DEAPLOG_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Python", "DEAPLOG.py")
+DEAPLOG_TIMEOUT = int(os.getenv("DEAPLOG_TIMEOUT", "1800"))
+
+
+# run DEAPLOG on a sample and return the last JSON line it prints
+def get_deaplog_results(sample_percent=0.01, step=0, sample_id="skin_TXK6Z4X_A1", timeout=DEAPLOG_TIMEOUT):
     if sample_id not in SAMPLES:
-        print(f"Error: Sample ID {sample_id} not found in SAMPLES.")
-        return result
-    
-    adata_path = SAMPLES[sample_id]["adata"]
-    adata = sc.read_h5ad(adata_path)
-    
-    filtered_adata = adata[adata.obs.index.isin(cellIds)]
+        raise ValueError(f"Sample ID '{sample_id}' not found in SAMPLES.")
+    if not os.path.exists(DEAPLOG_SCRIPT):
+        raise FileNotFoundError(f"DEAPLOG script not found at: {DEAPLOG_SCRIPT}")
+
+    data_path = os.path.abspath(SAMPLES[sample_id]["adata"])
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(f"Data file not found at: {data_path}")
+
+    cmd = [
+        sys.executable, DEAPLOG_SCRIPT,
+        "--sample_percent", str(sample_percent),
+        "--step", str(step),
+        "--data_path", data_path,
+    ]
+    report_progress("deaplog")
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(DEAPLOG_SCRIPT)),
+        timeout=timeout,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"DEAPLOG process failed with code {result.returncode}: {result.stderr}")
+
+    for line in reversed(result.stdout.strip().split("\n")):
+        if line.strip().startswith("{"):
+            try:
+                return json.loads(line)
+            except json.JSONDecodeError:
+                continue
+    raise RuntimeError("No valid JSON data found in DEAPLOG output")
+
+
+# cells of a receiver / sender pair closer than this interact (Spacia's -d)
+INTERACTION_DISTANCE = 30
+INTERACTION_ENGINES = ("spacia", "proximity")
+
+# Spacia runs as a script in its own interpreter, in a temporary directory per
+# request; runs longer than this are killed
+SPACIA_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Spacia", "spacia.py")
+SPACIA_TIMEOUT = int(os.getenv("SPACIA_TIMEOUT", "1800"))
+
+
+# tab-separated cells x genes table (the format Spacia reads), formatted in
+# blocks of chunk_size rows; blocks of integral counts are written as integers,
+# which is much faster
+def _write_counts_table(path, X, cell_ids, gene_names, chunk_size=5000):
+    with open(path, "w") as f:
+        f.write("\t" + "\t".join(map(str, gene_names)) + "\n")
+        for start in range(0, X.shape[0], chunk_size):
+            block = X[start:start + chunk_size]
+            block = block.toarray() if issparse(block) else np.asarray(block)
+            if np.issubdtype(block.dtype, np.floating) and np.array_equal(block, np.round(block)):
+                block = block.astype(np.int64)
+            pd.DataFrame(block, index=cell_ids[start:start + chunk_size]).to_csv(f, sep="\t", header=False)
+
+
+# terminate a process started with start_new_session and everything in its
+# process group, killing whatever is still alive after grace seconds
+def _stop_process_group(proc, grace=5.0):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    try:
+        proc.communicate(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+
+    deadline = time.time() + grace
+    while time.time() < deadline:
+        try:
+            os.killpg(proc.pid, 0)
+        except OSError:
+            break
+        time.sleep(0.1)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+
+
+# Spacia's interaction records for the given cells, or None when it fails
+def _run_spacia(sample_id, adata, cell_idx, receiver, sender, receiverGene, senderGene, timeout):
+    filtered_adata = _materialize(adata[cell_idx])
     
     filtered_spatial = pd.DataFrame(
-        filtered_adata.obsm["spatial"],
-        columns=["cell_x", "cell_y"],
+        np.asarray(filtered_adata.obsm["spatial"])[:, :2],
+        columns=["X", "Y"],
         index=filtered_adata.obs.index,
     )
     filtered_spatial["cell_type"] = filtered_adata.obs["cell_type"]
-    filtered_spatial.rename(columns={"cell_x": "X", "cell_y": "Y"}, inplace=True)
-    
-    spatial_file = f"{sample_id}_spatial.txt"
-    filtered_spatial.to_csv(spatial_file, sep="\t", index=True, index_label="")
-    
-    counts_data = filtered_adata.to_df()
-    counts_file = f"{sample_id}_counts.txt"
-    counts_data.to_csv(counts_file, sep="\t", index=True, index_label="")
-    
-    script_path = "../Spacia/spacia.py"
-    output_path = "cell2cellinteractionOutput"
 
     if isinstance(receiverGene, list):
         receiverGene = "|".join(receiverGene)
     if isinstance(senderGene, list):
         senderGene = "|".join(senderGene)
 
-    params = f'-rc {receiver} -sc {sender} -rf "{receiverGene}" -sf {senderGene} -d 30 -nc 20'
+    # inputs and output live in a directory of their own, removed afterwards,
+    # so concurrent requests never share files
+    with tempfile.TemporaryDirectory(prefix="spacia-") as work_dir:
+        spatial_file = os.path.join(work_dir, f"{sample_id}_spatial.txt")
+        filtered_spatial.to_csv(spatial_file, sep="\t", index=True, index_label="")
+
+        counts_file = os.path.join(work_dir, f"{sample_id}_counts.txt")
+        _write_counts_table(counts_file, filtered_adata.X, filtered_adata.obs_names.to_numpy(dtype=str),
+                            filtered_adata.var_names)
+
+        output_path = os.path.join(work_dir, "cell2cellinteractionOutput")
+        cmd = [
+            sys.executable, os.path.abspath(SPACIA_SCRIPT), counts_file, spatial_file,
+            "-rc", str(receiver), "-sc", str(sender), "-rf", receiverGene, "-sf", senderGene,
+            "-d", str(INTERACTION_DISTANCE), "-nc", "20", "-o", output_path,
+        ]
+        print(f"Running command: {subprocess.list2cmdline(cmd)}")
+        report_progress("spacia")
+
+        # Spacia runs in a session of its own so that, on a timeout or when this
+        # process is stopped, its children (the R backend) are stopped with it
+        # before the working directory is removed
+        proc = subprocess.Popen(cmd, cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, start_new_session=True)
+        finished = False
+        try:
+            _, stderr = proc.communicate(timeout=timeout)
+            finished = True
+        except subprocess.TimeoutExpired:
+            print(f"Error: Spacia timed out after {timeout}s for {sample_id}.")
+            return None
+        finally:
+            if not finished:
+                _stop_process_group(proc)
+        if proc.returncode != 0:
+            print(f"Error: Spacia exited with code {proc.returncode} for {sample_id}: {stderr.strip()[-2000:]}")
+            return None
+
+        interaction_file = os.path.join(output_path, "interaction.txt")
+        if not os.path.exists(interaction_file):
+            print(f"Error: Interaction file for {sample_id} not found.")
+            return None
+        return pd.read_csv(interaction_file, sep="\t").to_dict(orient="records")
+
+
+# permutation test of the proximity engine: number of random reassignments of
+# expression among sender cells, the processes they are spread over, and the
+# adjusted p-value below which a receiver cell counts as interacting
+INTERACTION_PERMUTATIONS = int(os.getenv("INTERACTION_PERMUTATIONS", "1000"))
+INTERACTION_N_JOBS = int(os.getenv("INTERACTION_N_JOBS", "-1"))
+INTERACTION_ALPHA = 0.05
+# smaller problems (graph edges x permutations) are tested in-process
+INTERACTION_PARALLEL_MIN_WORK = 50_000_000
+
+
+# permutations are drawn in batches with a seed each, so p-values do not depend
+# on how the batches are spread over processes
+INTERACTION_PERMUTATION_BATCH = 64
+
+
+# for every receiver, how many shuffles of the sender scores give a
+# neighbourhood mean at least as high as the observed one; batches holds
+# (n_permutations, seed) pairs
+def _count_permutation_exceedances(neighbour_mean, sender_score, observed, batches):
+    exceedances = np.zeros(len(observed), dtype=np.int64)
+    for n_permutations, seed in batches:
+        shuffled = np.repeat(sender_score[:, None], n_permutations, axis=1)
+        np.random.default_rng(seed).permuted(shuffled, axis=0, out=shuffled)
+        exceedances += (neighbour_mean @ shuffled >= observed[:, None] - 1e-12).sum(axis=1)
+    return exceedances
+
+
+# native alternative to Spacia: receivers and senders closer than distance are
+# linked, a receiver's score is its receptor expression times the mean ligand
+# expression of its linked senders, and its p-value comes from shuffling ligand
+# expression among the senders. Returns the links of significant receivers, in
+# Spacia's Receiver / Sender layout
+def score_proximity_interactions(coords, cell_ids, is_receiver, is_sender, receiver_score, sender_score,
+                                 distance=INTERACTION_DISTANCE, n_permutations=INTERACTION_PERMUTATIONS,
+                                 n_jobs=INTERACTION_N_JOBS, alpha=INTERACTION_ALPHA, random_state=0):
+    receivers = np.flatnonzero(is_receiver)
+    senders = np.flatnonzero(is_sender)
+    receiver_score = np.asarray(receiver_score, dtype=np.float64)[receivers]
+    sender_score = np.asarray(sender_score, dtype=np.float64)[senders]
+
+    links = cKDTree(coords[receivers]).sparse_distance_matrix(
+        cKDTree(coords[senders]), distance, output_type="ndarray")
+    links = links[receivers[links["i"]] != senders[links["j"]]]
+    if len(links) == 0:
+        return []
+
+    # row-normalized receiver x sender graph: neighbour_mean @ scores averages
+    # each receiver's linked senders
+    degree = np.bincount(links["i"], minlength=len(receivers))
+    neighbour_mean = csr_matrix(
+        (1.0 / degree[links["i"]], (links["i"], links["j"])),
+        shape=(len(receivers), len(senders)),
+    )
+    observed = neighbour_mean @ sender_score
+
+    # only receivers expressing the receptor next to expressed ligand are tested
+    tested = np.flatnonzero((receiver_score > 0) & (observed > 0))
+    if len(tested) == 0:
+        return []
+    neighbour_mean = neighbour_mean[tested]
+
+    sizes = np.diff(np.r_[np.arange(0, n_permutations, INTERACTION_PERMUTATION_BATCH), n_permutations])
+    batches = list(zip(sizes.tolist(), np.random.SeedSequence(random_state).spawn(len(sizes))))
+    report_progress("permutation test")
+    n_workers = max(1, min(effective_n_jobs(n_jobs), len(batches)))
+    if neighbour_mean.nnz * n_permutations < INTERACTION_PARALLEL_MIN_WORK:
+        n_workers = 1
+    exceedances = sum(Parallel(n_jobs=n_workers)(
+        delayed(_count_permutation_exceedances)(neighbour_mean, sender_score, observed[tested], batches[i::n_workers])
+        for i in range(n_workers)
+    ))
+
+    p_values = (exceedances + 1) / (n_permutations + 1)
+    adjusted = _benjamini_hochberg(p_values)
+    significant = adjusted < alpha
+    if not significant.any():
+        return []
+
+    # the links of significant receivers to senders expressing the ligand
+    receiver_rows = pd.Series(np.arange(len(tested))[significant], index=tested[significant])
+    links = links[np.isin(links["i"], receiver_rows.index) & (sender_score[links["j"]] > 0)]
+    rows = receiver_rows.loc[links["i"]].to_numpy()
+    interactions = pd.DataFrame({
+        "Receiver": cell_ids[receivers[links["i"]]],
+        "Sender": cell_ids[senders[links["j"]]],
+        "Distance": links["v"],
+        "Score": receiver_score[links["i"]] * sender_score[links["j"]],
+        "Receiver score": receiver_score[links["i"]] * observed[links["i"]],
+        "P-value": p_values[rows],
+        "Adjusted P-value": adjusted[rows],
+    })
+    interactions = interactions.sort_values(["Adjusted P-value", "Score"], ascending=[True, False], kind="stable")
+    return interactions.to_dict(orient="records")
+
+
+# proximity engine on the given cells: each cell's score for a gene list is the
+# mean log1p expression of those genes
+def _run_proximity(sample_id, adata, cell_idx, receiver, sender, receiverGene, senderGene):
+    gene_lists = []
+    for genes in (receiverGene, senderGene):
+        genes = genes.split("|") if isinstance(genes, str) else list(genes)
+        gene_idx = adata.var_names.get_indexer(genes)
+        if len(genes) == 0 or (gene_idx < 0).any():
+            missing = [gene for gene, i in zip(genes, gene_idx) if i < 0]
+            print(f"Error: genes {missing} not found in {sample_id}.")
+            return None
+        gene_lists.append(gene_idx)
+
+    receiver_score, sender_score = (
+        np.log1p(_read_expression(adata, cell_idx, gene_idx).astype(np.float64)).mean(axis=1)
+        for gene_idx in gene_lists
+    )
+    cell_types = adata.obs["cell_type"].to_numpy()[cell_idx].astype(str)
+    return score_proximity_interactions(
+        np.asarray(adata.obsm["spatial"], dtype=np.float64)[cell_idx, :2],
+        adata.obs_names.to_numpy(dtype=str)[cell_idx],
+        cell_types == str(receiver),
+        cell_types == str(sender),
+        receiver_score,
+        sender_score,
+    )
+
+
+# engine is "spacia" (the default) or "proximity" (score_proximity_interactions)
+def get_cell_cell_interaction_data(sample_id, receiver, sender, receiverGene, senderGene, cellIds, selection=None,
+                                   timeout=SPACIA_TIMEOUT, engine="spacia"):
+    result = {}
+
+    if engine not in INTERACTION_ENGINES:
+        raise ValueError(f"Unknown interaction engine '{engine}', expected one of {list(INTERACTION_ENGINES)}")
     
-    cmd = f"python {script_path} {counts_file} {spatial_file} {params} -o {output_path}"
-    print(f"Running command: {cmd}")
+    if sample_id not in SAMPLES:
+        print(f"Error: Sample ID {sample_id} not found in SAMPLES.")
+        return result
     
-    os.system(cmd)
+    adata = sample_registry.get(sample_id)
     
-    interaction_file = os.path.join(output_path, "interaction.txt")
-    if os.path.exists(interaction_file):
-        interaction_df = pd.read_csv(interaction_file, sep="\t")
-        result[sample_id] = interaction_df.to_dict(orient="records")
+    if selection is not None:
+        cell_idx = select_cell_indices(sample_id, selection)
     else:
-        print(f"Error: Interaction file for {sample_id} not found.")
-    
-    return result
\ No newline at end of file
+        cell_idx = np.flatnonzero(adata.obs.index.isin(cellIds))
+
+    # only receiver and sender cells take part in the interaction
+    cell_types = adata.obs["cell_type"].to_numpy()[cell_idx]
+    cell_idx = cell_idx[np.isin(cell_types.astype(str), [str(receiver), str(sender)])]
+
+    report_progress("loading")
+    if engine == "proximity":
+        interactions = _run_proximity(sample_id, adata, cell_idx, receiver, sender, receiverGene, senderGene)
+    else:
+        interactions = _run_spacia(sample_id, adata, cell_idx, receiver, sender, receiverGene, senderGene, timeout)
+
+    if interactions is not None:
+        result[sample_id] = interactions
+    return result
@@ -0,0 +1,92 @@
+import warnings
+
+import numpy as np
+from scipy.optimize import fsolve
+
+from process import (
+    KOSARA_LUT_ANGLE_TOLERANCE,
+    KOSARA_LUT_MIN_RATIO,
+    KOSARA_LUT_RADIUS_TOLERANCE,
+    KOSARA_RADIUS,
+    _kosara_equation,
+    _kosara_lookup_table,
+    _kosara_special_value,
+    lookup_kosara_radius,
+    solve_kosara_radius,
+)
+
+
+# the per-cell fsolve solver get_kosara_data used before the vectorized one
+def fsolve_kosara_radius(a_value, radius_val=KOSARA_RADIUS):
+    d = np.sqrt(2) * radius_val
+    special_value = _kosara_special_value(radius_val)
+
+    if a_value == 0:
+        return 0, 0
+
+    if a_value <= special_value:
+        guess = d + 0.01
+    elif a_value > 0.95:
+        guess = 8
+    else:
+        guess = a_value * 10 - 1.5
+
+    cal_radius = fsolve(_kosara_equation, guess, args=(d, a_value, radius_val, special_value))[0]
+    angle = np.degrees(np.arccos((cal_radius**2 + d**2 - radius_val**2) / (2 * cal_radius * d)))
+    return cal_radius, angle
+
+
+def test_vectorized_solver_matches_fsolve():
+    ratios = np.concatenate([
+        [0.0, 1e-9, 1e-6, 1e-4, 1e-3, 0.5, 0.95, 0.999, 1.0],
+        np.random.default_rng(0).uniform(0, 1, 2000),
+    ])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = np.array([fsolve_kosara_radius(a) for a in ratios])
+    radius, angle = solve_kosara_radius(ratios)
+
+    np.testing.assert_allclose(radius, expected[:, 0], rtol=1e-6, atol=1e-6)
+
+    # as the ratio approaches 1 the angle goes to 0 like sqrt(d + radius - r),
+    # which amplifies where fsolve stops; allow a slightly looser bound there
+    near_full = ratios > 0.99
+    np.testing.assert_allclose(angle[~near_full], expected[~near_full, 1], rtol=1e-6, atol=1e-4)
+    np.testing.assert_allclose(angle[near_full], expected[near_full, 1], atol=1e-2)
+
+
+def test_vectorized_solver_keeps_shape_and_handles_invalid_ratios():
+    ratios = np.array([[0.0, 0.25], [np.nan, 1.5]])
+    radius, angle = solve_kosara_radius(ratios)
+
+    assert radius.shape == ratios.shape and angle.shape == ratios.shape
+    assert radius[0, 0] == 0 and angle[0, 0] == 0
+    assert np.isnan(radius[1]).all() and np.isnan(angle[1]).all()
+
+    d = np.sqrt(2) * KOSARA_RADIUS
+    residual = _kosara_equation(radius[0, 1], d, 0.25, KOSARA_RADIUS, _kosara_special_value(KOSARA_RADIUS))
+    assert abs(residual) < 1e-9
+
+
+def test_lookup_table_within_error_bound():
+    table = _kosara_lookup_table()
+    assert table["max_radius_error"] <= KOSARA_LUT_RADIUS_TOLERANCE
+    assert table["max_angle_error"] <= KOSARA_LUT_ANGLE_TOLERANCE
+
+    ratios = np.concatenate([
+        [0.0, KOSARA_LUT_MIN_RATIO, 1e-6, 0.5, 1 - 1e-9, 1.0, np.nan, 2.0],
+        np.random.default_rng(1).uniform(0, 1, 20000),
+    ])
+    radius, angle = lookup_kosara_radius(ratios)
+    expected_radius, expected_angle = solve_kosara_radius(ratios)
+
+    np.testing.assert_allclose(radius, expected_radius, rtol=0, atol=KOSARA_LUT_RADIUS_TOLERANCE)
+    np.testing.assert_allclose(angle, expected_angle, rtol=0, atol=KOSARA_LUT_ANGLE_TOLERANCE)
+
+
+if __name__ == "__main__":
+    test_vectorized_solver_matches_fsolve()
+    test_vectorized_solver_keeps_shape_and_handles_invalid_ratios()
+    test_lookup_table_within_error_bound()
+    print("Kosara solver tests passed!")